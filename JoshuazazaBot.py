@@ -7,12 +7,19 @@ import os
 import re
 import sys
 import json
+import functools
 import asyncio
 import hashlib
-import uuid
+import html
+import time
+import traceback
 from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from PIL import Image
+# One tesseract thread per call; parallelism comes from the worker pool
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
 import pytesseract
 
 import psycopg
@@ -22,10 +29,20 @@ from psycopg.types.json import Json
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, filters, 
-    ContextTypes, ConversationHandler, CallbackQueryHandler, CallbackContext
+    ContextTypes, ConversationHandler, CallbackQueryHandler, Defaults, PicklePersistence, CallbackContext
 )
+from telegram.request import HTTPXRequest
+from telegram.error import NetworkError
+from telegram.helpers import escape_markdown
 from dotenv import load_dotenv
 
+from grading_common import (
+    USE_EMBEDDINGS, EMBED_MODEL, hash_password, verify_password, new_id,
+    generate_assignment_code, get_cached_teacher, store_teacher, forget_teacher,
+    score_percentage, normalize_text, normalize_expected, embed_text,
+    precompute_answer_embeddings, count_keyword_matches, semantic_score
+)
+
 # Import for Excel export with safety
 try:
     import pandas as pd
@@ -33,14 +50,21 @@ try:
 except ImportError:
     PANDAS_AVAILABLE = False
 
-# NLP & AI
+load_dotenv()
+
+# libuv-based event loop (not available on Windows)
 try:
-    from sentence_transformers import SentenceTransformer, util
-    EMBED_MODEL = SentenceTransformer('all-MiniLM-L6-v2')
-    USE_EMBEDDINGS = True
-except:
-    EMBED_MODEL = None
-    USE_EMBEDDINGS = False
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
+
+# Persistent Tesseract API (keeps the LSTM model loaded between calls)
+try:
+    import tesserocr
+    TESSEROCR_AVAILABLE = True
+except ImportError:
+    TESSEROCR_AVAILABLE = False
 
 # Voice to text
 try:
@@ -58,8 +82,6 @@ try:
 except:
     GEMINI_AVAILABLE = False
 
-load_dotenv()
-
 # --- BEGIN: tiny HTTP health server so Render detects a bound port ---
 import threading
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
@@ -82,8 +104,10 @@ def _start_health_server():
     print(f"[health] Listening on 0.0.0.0:{port}")
     server.serve_forever()
 
-# start server in daemon thread so it doesn't block bot
-threading.Thread(target=_start_health_server, daemon=True).start()
+# start server in daemon thread so it doesn't block bot; in webhook mode the
+# webhook server binds PORT instead
+if not os.getenv("WEBHOOK_URL"):
+    threading.Thread(target=_start_health_server, daemon=True).start()
 # --- END health server ---
 
 
@@ -96,6 +120,18 @@ SUPER_ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Webhook mode: set WEBHOOK_URL to the bot's public https base URL and
+# Telegram pushes updates to PORT instead of the bot long-polling for them
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+
+# Conversation state and user_data survive restarts in this file; PTB
+# flushes it every STATE_FLUSH_INTERVAL seconds rather than per update
+STATE_FILE = os.getenv("STATE_FILE", "joshuazaza_state.pkl")
+STATE_FLUSH_INTERVAL = 5
+PORT = int(os.getenv("PORT", "10000"))
+
 if not TELEGRAM_TOKEN:
     print("❌ ERROR: TELEGRAM_TOKEN missing in .env file!")
     sys.exit(1)
@@ -104,6 +140,25 @@ if not DATABASE_URL:
     print("❌ ERROR: DATABASE_URL missing in environment variables!")
     sys.exit(1)
 
+# Worker pool for blocking OCR / embedding work, so the event loop keeps
+# serving other users while one submission is being graded
+POOL_WORKERS = os.cpu_count() or 1
+_POOL = ThreadPoolExecutor(max_workers=POOL_WORKERS)
+# Bounded pool behind asyncio.to_thread for short DB calls and hashing, kept
+# apart from _POOL so a grading burst never queues ahead of a login lookup
+DB_WORKERS = 8
+# OCR may hold at most half the pool, so a burst of photos cannot starve
+# text submissions waiting to be graded
+OCR_SEMAPHORE = asyncio.Semaphore(max(1, (os.cpu_count() or 2) // 2))
+
+# Upper bounds on typed input, so one message can't bloat a DB row or push
+# an echoing reply past Telegram's 4096 character limit
+MAX_NAME_LEN = 100
+MAX_USERNAME_LEN = 40
+MAX_TITLE_LEN = 120
+MAX_QUESTION_LEN = 2000
+MAX_QUICK_GRADE_LEN = 1000  # question, correct and student answer are all echoed back
+
 # Initialize Gemini if API key available
 GEMINI_MODEL = None
 if GEMINI_API_KEY and GEMINI_AVAILABLE:
@@ -127,6 +182,39 @@ if os.name == "nt":
  EDIT_ASSIGNMENT, VIEW_SUBMISSION_DETAILS, STUDENT_FILL_DETAILS,
  STUDENT_HISTORY, MANUAL_GRADING) = range(20)
 
+# Plain typed text (not a /command); one filter object shared by every text state
+TEXT_INPUT = filters.TEXT & ~filters.COMMAND
+
+# Menus that never change are built once instead of on every button press
+ROLE_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👨‍🏫 Teacher Account", callback_data="teacher_mode")],
+    [InlineKeyboardButton("👨‍🎓 Student", callback_data="student_mode")],
+    [InlineKeyboardButton("❓ Help", callback_data="show_help")]
+])
+# /start variant for users who already have a teacher account
+ROLE_LOGIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👨‍🏫 Login to Teacher Account", callback_data="teacher_login")],
+    [InlineKeyboardButton("👨‍🎓 Student", callback_data="student_mode")],
+    [InlineKeyboardButton("❓ Help", callback_data="show_help")]
+])
+
+TEACHER_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Create Assignment", callback_data="create_assignment")],
+    [InlineKeyboardButton("📋 My Assignments", callback_data="my_assignments")],
+    [InlineKeyboardButton("⚡ Quick Grade", callback_data="quick_grade")],
+    [InlineKeyboardButton("📊 Results & Analytics", callback_data="view_results")],
+    [InlineKeyboardButton("🚪 Logout", callback_data="logout")]
+])
+
+STUDENT_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔍 Find Assignment", callback_data="find_assignment")],
+    [InlineKeyboardButton("📜 My Answer History", callback_data="my_history")],
+    [InlineKeyboardButton("⚡ Quick Grade", callback_data="quick_grade_student")],
+    [InlineKeyboardButton("🔙 Back", callback_data="back_to_start")]
+])
+
+HELP_BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Start", callback_data="back_to_start")]])
+
 # ============================================================================
 # DATABASE SETUP - POSTGRESQL
 # ============================================================================
@@ -144,7 +232,9 @@ def init_db():
         # Teachers table
         cur.execute('''CREATE TABLE IF NOT EXISTS teachers
             (teacher_id SERIAL PRIMARY KEY, telegram_id BIGINT UNIQUE, username TEXT UNIQUE,
-             password TEXT, full_name TEXT, created_at TIMESTAMP, grading_scale INT DEFAULT 100)''')
+             password TEXT, full_name TEXT, created_at TIMESTAMP, grading_scale INT DEFAULT 100,
+             salt TEXT)''')
+        cur.execute("ALTER TABLE teachers ADD COLUMN IF NOT EXISTS salt TEXT")
         
         # Questions/Assignments table - EXPANDED
         cur.execute('''CREATE TABLE IF NOT EXISTS assignments
@@ -168,6 +258,11 @@ def init_db():
              answer_given TEXT, score REAL, max_score INT,
              graded_at TIMESTAMP, FOREIGN KEY(teacher_id) REFERENCES teachers(teacher_id))''')
         
+        # code, username and telegram_id are UNIQUE and already indexed; these
+        # cover the per-assignment submission and per-teacher assignment lookups
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_submissions_assignment ON submissions(assignment_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_assignments_teacher ON assignments(teacher_id, created_at)")
+        
         conn.commit()
         cur.close()
         conn.close()
@@ -183,26 +278,18 @@ def init_db():
 # HELPER FUNCTIONS
 # ============================================================================
 
-def hash_password(password):
-    """Hash password for security"""
-    return hashlib.sha256(password.encode()).hexdigest()
-
-def generate_assignment_code():
-    """Generate unique assignment code"""
-    return str(uuid.uuid4())[:8].upper()
-
-def register_teacher(telegram_id, username, password, full_name, grading_scale=100):
-    """Register new teacher"""
+def register_teacher(telegram_id, username, hashed_pass, salt, full_name, grading_scale=100):
+    """Register new teacher with a password already hashed by hash_password"""
     conn = get_db_connection()
     cur = conn.cursor()
     
     try:
-        hashed_pass = hash_password(password)
-        cur.execute('''INSERT INTO teachers (telegram_id, username, password, full_name, grading_scale, created_at)
-                     VALUES (%s, %s, %s, %s, %s, %s) RETURNING teacher_id''',
-                  (telegram_id, username, hashed_pass, full_name, grading_scale, datetime.now()))
+        cur.execute('''INSERT INTO teachers (telegram_id, username, password, salt, full_name, grading_scale, created_at)
+                     VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING teacher_id''',
+                  (telegram_id, username, hashed_pass, salt, full_name, grading_scale, datetime.now()))
         teacher_id = cur.fetchone()[0]
         conn.commit()
+        forget_teacher(telegram_id)
         return True, teacher_id
     except psycopg.IntegrityError:
         return False, None
@@ -215,37 +302,88 @@ def login_teacher(username, password):
     conn = get_db_connection()
     cur = conn.cursor()
     
-    hashed_pass = hash_password(password)
-    cur.execute("SELECT teacher_id, full_name FROM teachers WHERE username=%s AND password=%s",
-              (username, hashed_pass))
-    result = cur.fetchone()
+    cur.execute("SELECT teacher_id, full_name, password, salt FROM teachers WHERE username=%s",
+              (username,))
+    row = cur.fetchone()
+    
+    if not row or not verify_password(password, row[2], row[3]):
+        cur.close()
+        conn.close()
+        return None, None
+    
+    teacher_id, full_name, _, salt = row
+    if not salt:
+        # Legacy SHA-256 account: upgrade to scrypt now that we have the password
+        hashed_pass, salt = hash_password(password)
+        cur.execute("UPDATE teachers SET password=%s, salt=%s WHERE teacher_id=%s",
+                  (hashed_pass, salt, teacher_id))
+        conn.commit()
     cur.close()
     conn.close()
     
-    return result if result else (None, None)
+    return teacher_id, full_name
 
 def teacher_exists_by_telegram(telegram_id):
     """Check if teacher account exists"""
+    found, result = get_cached_teacher(telegram_id)
+    if found:
+        return result
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute("SELECT teacher_id, full_name FROM teachers WHERE telegram_id=%s", (telegram_id,))
     result = cur.fetchone()
     cur.close()
     conn.close()
+    store_teacher(telegram_id, result)
     return result
 
-def normalize_text(s):
-    """Normalize text"""
-    if not s:
-        return ""
-    s = str(s).lower().strip()
-    s = re.sub(r'[^a-z0-9\s]', ' ', s)
-    s = re.sub(r'\s+', ' ', s)
-    return s
+def save_quick_grade(teacher_id, question, answer_given, score, max_score):
+    """Store a quick-grade result for a teacher"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute('''INSERT INTO quick_grades
+                    (grade_id, teacher_id, question, answer_given, score, max_score, graded_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)''',
+                  (new_id(), teacher_id, question, answer_given, score, max_score, datetime.now()))
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+
+async def log_quick_grade(teacher_id, question, answer_given, score, max_score):
+    """Save a quick grade in the background, logging instead of raising on failure"""
+    try:
+        await asyncio.to_thread(save_quick_grade, teacher_id, question, answer_given, score, max_score)
+    except Exception as e:
+        print(f"⚠️ Failed to save quick grade: {e}")
+
+async def reject_long_input(message, text, limit):
+    """Ask for a shorter reply if text is over limit, returns True when rejected"""
+    if len(text) <= limit:
+        return False
+    await message.reply_text(f"❌ That's too long ({len(text)} characters, max {limit}). Please send a shorter one:")
+    return True
+
+_RE_UNSAFE_FILENAME = re.compile(r'[<>:"/\\|?*]')
+
+def precompute_stored_answer_embeddings():
+    """Encode the expected answers of existing AI Semantic assignments"""
+    if not USE_EMBEDDINGS:
+        return
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT answers FROM assignments WHERE question_type='AI Semantic' AND is_active=1 "
+                "ORDER BY created_at DESC LIMIT 1024")
+    answers = [row[0] for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+    precompute_answer_embeddings(answers)
+    print(f"✅ Precomputed {len(answers)} answer embeddings")
 
 def format_score_with_color(score, max_score):
     """Format score with color coding (emoji indicators)"""
-    percentage = (score / max_score * 100) if max_score > 0 else 0
+    percentage = score_percentage(score, max_score)
     if percentage >= 80:
         emoji = "🟢"
     elif percentage >= 60:
@@ -268,11 +406,104 @@ def get_deadline_string(deadline_at):
     deadline = deadline_at if isinstance(deadline_at, datetime) else datetime.fromisoformat(deadline_at)
     return deadline.strftime("%B %d, %Y at %I:%M %p")
 
+# Tesseract gains little past ~300 DPI but runtime grows with pixel count
+OCR_MAX_EDGE = 1600
+
+def otsu_threshold(hist):
+    """Pick the binarization threshold maximizing between-class variance"""
+    total = sum(hist)
+    sum_all = sum(i * h for i, h in enumerate(hist))
+    sum_b = w_b = 0
+    best_t, best_var = 0, 0.0
+    for t in range(256):
+        w_b += hist[t]
+        if w_b == 0:
+            continue
+        w_f = total - w_b
+        if w_f == 0:
+            break
+        sum_b += t * hist[t]
+        m_b = sum_b / w_b
+        m_f = (sum_all - sum_b) / w_f
+        var = w_b * w_f * (m_b - m_f) ** 2
+        if var > best_var:
+            best_t, best_var = t, var
+    return best_t
+
+def preprocess_for_ocr(img):
+    """Grayscale, downscale and binarize a photo before Tesseract"""
+    img = img.convert("L")
+    scale = OCR_MAX_EDGE / max(img.size)
+    if scale < 1:
+        img = img.resize((int(img.width * scale), int(img.height * scale)), Image.Resampling.BOX)
+    t = otsu_threshold(img.histogram())
+    return img.point(lambda p: 255 if p > t else 0)
+
+_TESS_TLS = threading.local()
+
+def tess_api():
+    """Per-thread tesserocr API (PyTessBaseAPI is not thread-safe)"""
+    api = getattr(_TESS_TLS, "api", None)
+    if api is None:
+        api = _TESS_TLS.api = tesserocr.PyTessBaseAPI(
+            lang="eng", psm=tesserocr.PSM.SINGLE_BLOCK, oem=tesserocr.OEM.LSTM_ONLY
+        )
+    return api
+
+@functools.lru_cache(maxsize=1)
+def easyocr_reader():
+    """Build the EasyOCR reader once; loading its detector/recognizer takes seconds"""
+    import easyocr
+    return easyocr.Reader(['en'], gpu=False)
+
+def image_to_text(image_bytes, use_easyocr=False):
+    """Run OCR on image bytes (blocking - call through _POOL)"""
+    if use_easyocr:
+        reader = easyocr_reader()
+        return "\n".join(reader.readtext(image_bytes, detail=0, paragraph=True))
+    img = preprocess_for_ocr(Image.open(BytesIO(image_bytes)))
+    if TESSEROCR_AVAILABLE:
+        api = tess_api()
+        api.SetImage(img)
+        return api.GetUTF8Text()
+    # --psm 6: answers are a single text block, skip full page segmentation
+    return pytesseract.image_to_string(img, config="--oem 1 --psm 6")
+
+# OCR text keyed by a digest of the image bytes, so re-sent or forwarded
+# photos skip OCR. Only touched from the event loop, so no lock is needed.
+OCR_CACHE_SIZE = 256
+_OCR_CACHE = OrderedDict()
+
+def get_cached_ocr_text(image_key):
+    """Cached OCR text for an image digest, or None"""
+    text = _OCR_CACHE.get(image_key)
+    if text is not None:
+        _OCR_CACHE.move_to_end(image_key)
+    return text
+
+def store_ocr_text(image_key, text):
+    """Add OCR text to the LRU cache, evicting the oldest entry when full"""
+    _OCR_CACHE[image_key] = text
+    if len(_OCR_CACHE) > OCR_CACHE_SIZE:
+        _OCR_CACHE.popitem(last=False)
+
+def voice_to_text(file_bytes, use_pydub=False):
+    """Transcribe a voice note (blocking - call through _POOL)"""
+    if use_pydub:
+        from pydub import AudioSegment
+        audio = AudioSegment.from_ogg(BytesIO(file_bytes))
+        wav_io = BytesIO()
+        audio.export(wav_io, format="wav")
+        wav_bytes = wav_io.getvalue()
+        audio_data = sr.AudioData(wav_bytes, audio.frame_rate, audio.sample_width)
+    else:
+        audio_data = sr.AudioData(file_bytes, 16000, 2)
+    return SPEECH_RECOGNIZER.recognize_google(audio_data)
+
 def ocr_from_image_bytes(image_bytes):
     """Extract text from image"""
     try:
-        img = Image.open(BytesIO(image_bytes)).convert("RGB")
-        return pytesseract.image_to_string(img)
+        return image_to_text(image_bytes)
     except:
         return "[OCR failed]"
 
@@ -352,21 +583,24 @@ Scoring Rules:
 def grade_answer(student_answer, expected_answer, max_score, question_type="short"):
     """Grade student answer - uses Gemini AI if available for semantic mode"""
     sa = normalize_text(student_answer)
-    ea = normalize_text(expected_answer)
+    ea = normalize_expected(expected_answer)
     
     if question_type == "exact":
         score = max_score if sa == ea else 0
         detail = "✅ Exact match!" if score == max_score else "❌ Incorrect"
     
     elif question_type == "keyword":
-        score = 0
-        details = []
-        keywords = ea.split()
-        matched = sum(1 for kw in keywords if kw in sa)
-        score = int((matched / len(keywords) * max_score)) if keywords else 0
-        detail = f"Matched {matched}/{len(keywords)} keywords"
+        matched, total = count_keyword_matches(sa, ea)
+        score = int((matched / total * max_score)) if total else 0
+        detail = f"Matched {matched}/{total} keywords"
     
     elif question_type == "semantic":
+        # Cheap paths first: an identical or empty answer needs no model call
+        if sa == ea:
+            return max_score, "✅ Exact match!"
+        if not sa:
+            return 0, "❌ No answer given"
+        
         # Try Gemini first if available
         if GEMINI_MODEL:
             gemini_score, gemini_feedback = grade_with_gemini(student_answer, expected_answer, max_score, "semantic")
@@ -376,17 +610,11 @@ def grade_answer(student_answer, expected_answer, max_score, question_type="shor
         # Fallback to sentence-transformers embeddings
         if USE_EMBEDDINGS:
             try:
-                student_emb = EMBED_MODEL.encode(sa, convert_to_tensor=True)
-                expected_emb = EMBED_MODEL.encode(ea, convert_to_tensor=True)
-                similarity = float(util.cos_sim(student_emb, expected_emb))
-                if similarity > 0.8:
-                    score = max_score
-                elif similarity > 0.6:
-                    score = int(max_score * 0.7)
-                elif similarity > 0.4:
-                    score = int(max_score * 0.4)
-                else:
-                    score = 0
+                student_emb = embed_text(sa)
+                expected_emb = embed_text(ea)
+                # Embeddings are unit length, so the dot product is the cosine similarity
+                similarity = float(student_emb @ expected_emb)
+                score = semantic_score(similarity, max_score)
                 detail = f"📊 Semantic match: {similarity:.2f}"
             except:
                 score = 0
@@ -416,18 +644,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return TEACHER_MENU
     
     # Check if teacher account exists
-    teacher_info = teacher_exists_by_telegram(user_id)
-    
-    keyboard = [
-        [InlineKeyboardButton("👨‍🏫 Teacher Account", callback_data="teacher_mode")],
-        [InlineKeyboardButton("👨‍🎓 Student", callback_data="student_mode")],
-        [InlineKeyboardButton("❓ Help", callback_data="show_help")]
-    ]
+    teacher_info = await asyncio.to_thread(teacher_exists_by_telegram, user_id)
     
-    if teacher_info:
-        keyboard[0][0] = InlineKeyboardButton("👨‍🏫 Login to Teacher Account", callback_data="teacher_login")
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = ROLE_LOGIN_MENU_MARKUP if teacher_info else ROLE_MENU_MARKUP
     
     await update.message.reply_text(
         "👋 **Welcome!**\n\n"
@@ -446,10 +665,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def teacher_mode_selector(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Teacher: Register or Login"""
     query = update.callback_query
-    await query.answer()
-    
     user_id = query.from_user.id
-    teacher_info = teacher_exists_by_telegram(user_id)
+    _, teacher_info = await asyncio.gather(
+        query.answer(), asyncio.to_thread(teacher_exists_by_telegram, user_id)
+    )
     
     if teacher_info:
         # Account exists - show login
@@ -484,10 +703,10 @@ async def teacher_mode_selector(update: Update, context: ContextTypes.DEFAULT_TY
 async def direct_teacher_login(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Direct teacher login when they already have an account"""
     query = update.callback_query
-    await query.answer()
-    
     user_id = query.from_user.id
-    teacher_info = teacher_exists_by_telegram(user_id)
+    _, teacher_info = await asyncio.gather(
+        query.answer(), asyncio.to_thread(teacher_exists_by_telegram, user_id)
+    )
     
     if teacher_info:
         # Direct login since account exists
@@ -495,10 +714,7 @@ async def direct_teacher_login(update: Update, context: ContextTypes.DEFAULT_TYP
         context.user_data['teacher_id'] = teacher_id
         context.user_data['full_name'] = full_name
         
-        await query.edit_message_text(
-            f"✅ Welcome back, {full_name}!\n\n"
-            "Loading teacher menu..."
-        )
+        # show_teacher_menu edits this same message, no interim "loading" edit
         await show_teacher_menu(update, context)
         return TEACHER_MENU
     else:
@@ -558,15 +774,12 @@ async def handle_teacher_auth(update: Update, context: ContextTypes.DEFAULT_TYPE
         username = context.user_data.get('login_username')
         password = text
         
-        teacher_id, full_name = login_teacher(username, password)
+        # scrypt is deliberately slow, keep it off the event loop
+        teacher_id, full_name = await asyncio.to_thread(login_teacher, username, password)
         
         if teacher_id:
             context.user_data['teacher_id'] = teacher_id
             context.user_data['full_name'] = full_name
-            await update.message.reply_text(
-                f"✅ Welcome back, {full_name}!\n\n"
-                "Loading teacher menu..."
-            )
             await show_teacher_menu(update, context)
             return TEACHER_MENU
         else:
@@ -578,19 +791,24 @@ async def handle_teacher_auth(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     # REGISTER FLOW
     elif auth_step == 'register_name':
+        if await reject_long_input(update.message, text, MAX_NAME_LEN):
+            return TEACHER_REGISTER
         context.user_data['reg_name'] = text
         await update.message.reply_text("Step 2: Choose a username (for login)")
         context.user_data['auth_step'] = 'register_username'
         return TEACHER_REGISTER
     
     elif auth_step == 'register_username':
+        if await reject_long_input(update.message, text, MAX_USERNAME_LEN):
+            return TEACHER_REGISTER
         context.user_data['reg_username'] = text
         await update.message.reply_text("Step 3: Create a password")
         context.user_data['auth_step'] = 'register_password'
         return TEACHER_REGISTER
     
     elif auth_step == 'register_password':
-        context.user_data['reg_password'] = text
+        # Only the scrypt hash is kept in user_data, which is persisted to disk
+        context.user_data['reg_password_hash'], context.user_data['reg_salt'] = await asyncio.to_thread(hash_password, text)
         await update.message.reply_text("Step 4: Choose your grading scale (e.g., 5, 10, 20, 30, 100)")
         context.user_data['auth_step'] = 'register_scale'
         return TEACHER_REGISTER
@@ -603,25 +821,28 @@ async def handle_teacher_auth(update: Update, context: ContextTypes.DEFAULT_TYPE
                 return TEACHER_REGISTER
             
             # Register teacher
-            success, teacher_id = register_teacher(
+            success, teacher_id = await asyncio.to_thread(
+                register_teacher,
                 user_id,
                 context.user_data['reg_username'],
-                context.user_data['reg_password'],
+                context.user_data['reg_password_hash'],
+                context.user_data['reg_salt'],
                 context.user_data['reg_name'],
                 scale
             )
             
             if success:
+                context.user_data.pop('reg_password_hash', None)
+                context.user_data.pop('reg_salt', None)
                 context.user_data['teacher_id'] = teacher_id
                 context.user_data['full_name'] = context.user_data['reg_name']
-                await update.message.reply_text(
-                    f"✅ Account created successfully!\n\n"
-                    f"Name: {context.user_data['reg_name']}\n"
-                    f"Username: {context.user_data['reg_username']}\n"
+                await show_teacher_menu(
+                    update, context,
+                    header=f"✅ Account created successfully!\n\n"
+                    f"Name: {escape_markdown(context.user_data['reg_name'])}\n"
+                    f"Username: {escape_markdown(context.user_data['reg_username'])}\n"
                     f"Grading Scale: 0-{scale}\n\n"
-                    "Loading teacher menu..."
                 )
-                await show_teacher_menu(update, context)
                 return TEACHER_MENU
             else:
                 await update.message.reply_text(
@@ -637,24 +858,15 @@ async def handle_teacher_auth(update: Update, context: ContextTypes.DEFAULT_TYPE
 # TEACHER MENU & FEATURES
 # ============================================================================
 
-async def show_teacher_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show teacher main menu"""
+async def show_teacher_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, header=""):
+    """Show teacher main menu, prefixed by header (Markdown)"""
     teacher_id = context.user_data.get('teacher_id')
-    full_name = context.user_data.get('full_name', 'Teacher')
-    
-    keyboard = [
-        [InlineKeyboardButton("➕ Create Assignment", callback_data="create_assignment")],
-        [InlineKeyboardButton("📋 My Assignments", callback_data="my_assignments")],
-        [InlineKeyboardButton("⚡ Quick Grade", callback_data="quick_grade")],
-        [InlineKeyboardButton("📊 Results & Analytics", callback_data="view_results")],
-        [InlineKeyboardButton("🚪 Logout", callback_data="logout")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    full_name = escape_markdown(context.user_data.get('full_name', 'Teacher'))
+    reply_markup = TEACHER_MENU_MARKUP
     
     if isinstance(update, Update) and update.callback_query:
         await update.callback_query.edit_message_text(
-            f"👨‍🏫 **TEACHER DASHBOARD**\n\n"
+            f"{header}👨‍🏫 **TEACHER DASHBOARD**\n\n"
             f"Welcome back, {full_name}! 👋\n\n"
             "What would you like to do?",
             reply_markup=reply_markup,
@@ -662,7 +874,7 @@ async def show_teacher_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     else:
         await update.message.reply_text(
-            f"👨‍🏫 **TEACHER DASHBOARD**\n\n"
+            f"{header}👨‍🏫 **TEACHER DASHBOARD**\n\n"
             f"Welcome back, {full_name}! 👋\n\n"
             "What would you like to do?",
             reply_markup=reply_markup,
@@ -698,7 +910,7 @@ async def finalize_assignment(update: Update, context: ContextTypes.DEFAULT_TYPE
     scale = cur.fetchone()[0]
     
     # Create assignment
-    assignment_id = str(uuid.uuid4())
+    assignment_id = new_id()
     code = generate_assignment_code()
     required_fields = Json(context.user_data.get('required_fields', []))
     deadline_at = context.user_data.get('assign_deadline')
@@ -717,6 +929,11 @@ async def finalize_assignment(update: Update, context: ContextTypes.DEFAULT_TYPE
     cur.close()
     conn.close()
     
+    if context.user_data['assign_type'] == 'AI Semantic':
+        asyncio.get_running_loop().run_in_executor(
+            _POOL, precompute_answer_embeddings, [context.user_data['assign_answer']]
+        )
+    
     deadline_str = f"\n📅 **Deadline:** {get_deadline_string(deadline_at)}" if deadline_at else ""
     required_str = ""
     if context.user_data.get('required_fields'):
@@ -752,7 +969,7 @@ async def finalize_assignment_from_callback(update: Update, context: ContextType
     scale = cur.fetchone()[0]
     
     # Create assignment
-    assignment_id = str(uuid.uuid4())
+    assignment_id = new_id()
     code = generate_assignment_code()
     required_fields = Json(context.user_data.get('required_fields', []))
     deadline_at = context.user_data.get('assign_deadline')
@@ -771,6 +988,11 @@ async def finalize_assignment_from_callback(update: Update, context: ContextType
     cur.close()
     conn.close()
     
+    if context.user_data['assign_type'] == 'AI Semantic':
+        asyncio.get_running_loop().run_in_executor(
+            _POOL, precompute_answer_embeddings, [context.user_data['assign_answer']]
+        )
+    
     deadline_str = f"\n📅 **Deadline:** {get_deadline_string(deadline_at)}" if deadline_at else ""
     required_str = ""
     if context.user_data.get('required_fields'):
@@ -885,6 +1107,8 @@ async def handle_assignment_creation(update: Update, context: ContextTypes.DEFAU
     teacher_id = context.user_data.get('teacher_id')
     
     if assign_step == 'title':
+        if await reject_long_input(update.message, text, MAX_TITLE_LEN):
+            return CREATE_QUESTION
         context.user_data['assign_title'] = text
         await update.message.reply_text(
             "Step 2: Enter the question/assignment text"
@@ -893,6 +1117,8 @@ async def handle_assignment_creation(update: Update, context: ContextTypes.DEFAU
         return CREATE_QUESTION
     
     elif assign_step == 'question':
+        if await reject_long_input(update.message, text, MAX_QUESTION_LEN):
+            return CREATE_QUESTION
         context.user_data['assign_question'] = text
         keyboard = [
             [InlineKeyboardButton("✏️ Short Answer", callback_data="type_short")],
@@ -1376,6 +1602,7 @@ async def handle_edit_field_text(update: Update, context: ContextTypes.DEFAULT_T
             cur = conn.cursor()
             cur.execute('UPDATE assignments SET answers=%s WHERE assignment_id=%s', (text, assignment_id))
             conn.commit()
+            asyncio.get_running_loop().run_in_executor(_POOL, precompute_answer_embeddings, [text])
             await update.message.reply_text("✅ Correct answer updated successfully!")
             
         elif edit_mode == 'score':
@@ -1534,17 +1761,10 @@ async def student_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    keyboard = [
-        [InlineKeyboardButton("🔍 Find Assignment", callback_data="find_assignment")],
-        [InlineKeyboardButton("📜 My Answer History", callback_data="my_history")],
-        [InlineKeyboardButton("⚡ Quick Grade", callback_data="quick_grade_student")],
-        [InlineKeyboardButton("🔙 Back", callback_data="back_to_start")]
-    ]
-    
     await query.edit_message_text(
         "👨‍🎓 **STUDENT PORTAL**\n\n"
         "What would you like to do?",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=STUDENT_MENU_MARKUP,
         parse_mode="Markdown"
     )
     
@@ -1646,8 +1866,8 @@ async def handle_assignment_code(update: Update, context: ContextTypes.DEFAULT_T
         
         await update.message.reply_text(
             f"✅ <b>ASSIGNMENT FOUND!</b>\n\n"
-            f"📌 <b>Title:</b> {title}\n"
-            f"❓ <b>Question:</b> {question}\n"
+            f"📌 <b>Title:</b> {html.escape(title)}\n"
+            f"❓ <b>Question:</b> {html.escape(question)}\n"
             f"📊 <b>Max Score:</b> {max_score}/{scale}{deadline_info}\n\n"
             f"Ready to answer?",
             reply_markup=InlineKeyboardMarkup(keyboard),
@@ -1727,8 +1947,8 @@ async def handle_student_fill_details(update: Update, context: ContextTypes.DEFA
                 title, question, max_score, scale = assign
                 await update.message.reply_text(
                     f"✅ **All information saved!**\n\n"
-                    f"📌 **Assignment:** {title}\n"
-                    f"❓ **Question:** {question}\n"
+                    f"📌 **Assignment:** {escape_markdown(title)}\n"
+                    f"❓ **Question:** {escape_markdown(question)}\n"
                     f"📊 **Max Score:** {max_score}/{scale}\n\n"
                     f"Now submit your answer:",
                     reply_markup=InlineKeyboardMarkup(keyboard),
@@ -1760,37 +1980,27 @@ async def process_student_answer(update: Update, context: ContextTypes.DEFAULT_T
             file = await update.message.voice.get_file()
         else:
             file = await update.message.photo[-1].get_file()
-        file_bytes = await file.download_as_bytearray()
+        buf = BytesIO()
+        await file.download_to_memory(out=buf)
+        file_bytes = buf.getvalue()
 
         try:
+            loop = asyncio.get_running_loop()
             if update.message.voice:
                 # VOICE PROCESSING
-                if is_render:
-                    from pydub import AudioSegment
-                    audio = AudioSegment.from_ogg(BytesIO(file_bytes))
-                    wav_io = BytesIO()
-                    audio.export(wav_io, format="wav")
-                    wav_bytes = wav_io.getvalue()
-                    audio_data = sr.AudioData(wav_bytes, audio.frame_rate, audio.sample_width)
-                else:
-                    audio_data = sr.AudioData(file_bytes, 16000, 2)
-
-                text = SPEECH_RECOGNIZER.recognize_google(audio_data)
+                text = await loop.run_in_executor(_POOL, voice_to_text, file_bytes, is_render)
                 source = "Render (pydub)" if is_render else "Local"
                 answer_source = "voice"
 
             else:
                 # PHOTO / OCR PROCESSING
-                if is_render:
-                    import easyocr
-                    reader = easyocr.Reader(['en'], gpu=False)
-                    result = reader.readtext(file_bytes, detail=0, paragraph=True)
-                    text = "\n".join(result)
-                    source = "easyocr (Render)"
-                else:
-                    img = Image.open(BytesIO(file_bytes))
-                    text = pytesseract.image_to_string(img)
-                    source = "tesseract (Local)"
+                image_key = hashlib.blake2b(file_bytes, digest_size=16).digest()
+                text = get_cached_ocr_text(image_key)
+                if text is None:
+                    async with OCR_SEMAPHORE:
+                        text = await loop.run_in_executor(_POOL, image_to_text, file_bytes, is_render)
+                    store_ocr_text(image_key, text)
+                source = "easyocr (Render)" if is_render else "tesseract (Local)"
                 answer_source = "image"
 
             if not text.strip():
@@ -1833,10 +2043,13 @@ async def process_student_answer(update: Update, context: ContextTypes.DEFAULT_T
     }
     qtype_param = qtype_map.get(qtype, 'short')
     
-    score, detail = grade_answer(answer, correct_answers, max_score, qtype_param)
+    loop = asyncio.get_running_loop()
+    score, detail = await loop.run_in_executor(
+        _POOL, grade_answer, answer, correct_answers, max_score, qtype_param
+    )
     
     # Save submission
-    submission_id = str(uuid.uuid4())
+    submission_id = new_id()
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('''INSERT INTO submissions
@@ -2000,7 +2213,7 @@ async def handle_export_excel(update: Update, context: ContextTypes.DEFAULT_TYPE
                 'Answer': answer,
                 'Score': score or 0,
                 'Max Score': max_score,
-                'Percentage': f"{(score/max_score*100):.1f}%" if max_score > 0 else "0%",
+                'Percentage': f"{score_percentage(score or 0, max_score):.1f}%",
                 'Submitted At': submitted_at.strftime("%Y-%m-%d %H:%M:%S")
             }
             
@@ -2026,7 +2239,7 @@ async def handle_export_excel(update: Update, context: ContextTypes.DEFAULT_TYPE
         output.seek(0)
         
         # Create safe filename
-        safe_title = re.sub(r'[<>:"/\\|?*]', '_', title)[:50]
+        safe_title = _RE_UNSAFE_FILENAME.sub('_', title)[:50]
         filename = f"{safe_title}_submissions.xlsx"
         
         await query.message.reply_document(
@@ -2071,6 +2284,10 @@ async def handle_quick_grade(update: Update, context: ContextTypes.DEFAULT_TYPE)
     text = update.message.text.strip()
     step = context.user_data.get('quick_grade_step')
     
+    if step in ('question', 'correct_answer', 'student_answer'):
+        if await reject_long_input(update.message, text, MAX_QUICK_GRADE_LEN):
+            return QUICK_GRADE_MENU
+    
     if step == 'question':
         context.user_data['qg_question'] = text
         await update.message.reply_text(
@@ -2100,7 +2317,9 @@ async def handle_quick_grade(update: Update, context: ContextTypes.DEFAULT_TYPE)
             max_score = int(text)
             
             # Grade it
-            score, detail = grade_answer(
+            loop = asyncio.get_running_loop()
+            score, detail = await loop.run_in_executor(
+                _POOL, grade_answer,
                 context.user_data['qg_student_answer'],
                 context.user_data['qg_correct'],
                 max_score,
@@ -2114,11 +2333,11 @@ async def handle_quick_grade(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
             await update.message.reply_text(
                 f"✅ **GRADING RESULT**\n\n"
-                f"❓ **Question:** {context.user_data['qg_question']}\n"
-                f"📝 **Student Answer:** {context.user_data['qg_student_answer']}\n"
-                f"✏️ **Correct Answer:** {context.user_data['qg_correct']}\n\n"
+                f"❓ **Question:** {escape_markdown(context.user_data['qg_question'])}\n"
+                f"📝 **Student Answer:** {escape_markdown(context.user_data['qg_student_answer'])}\n"
+                f"✏️ **Correct Answer:** {escape_markdown(context.user_data['qg_correct'])}\n\n"
                 f"🏆 **Score:** {score}/{max_score}\n"
-                f"📊 **Percentage:** {(score/max_score*100):.1f}%\n"
+                f"📊 **Percentage:** {score_percentage(score, max_score):.1f}%\n"
                 f"💡 **Detail:** {detail}",
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode="Markdown"
@@ -2127,16 +2346,11 @@ async def handle_quick_grade(update: Update, context: ContextTypes.DEFAULT_TYPE)
             # Save to quick grades
             teacher_id = context.user_data.get('teacher_id')
             if teacher_id:
-                conn = get_db_connection()
-                cur = conn.cursor()
-                cur.execute('''INSERT INTO quick_grades
-                            (grade_id, teacher_id, question, answer_given, score, max_score, graded_at)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s)''',
-                          (str(uuid.uuid4()), teacher_id, context.user_data['qg_question'],
-                           context.user_data['qg_student_answer'], score, max_score, datetime.now()))
-                conn.commit()
-                cur.close()
-                conn.close()
+                # Bookkeeping only; don't hold up the next message on the insert
+                context.application.create_task(log_quick_grade(
+                    teacher_id, context.user_data['qg_question'],
+                    context.user_data['qg_student_answer'], score, max_score
+                ))
             
             context.user_data['quick_grade_step'] = None
             return QUICK_GRADE_MENU
@@ -2300,7 +2514,7 @@ async def student_view_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = []
     
     for sub in submissions:
-        percentage = (sub['score'] / sub['max_score'] * 100) if sub['max_score'] > 0 else 0
+        percentage = score_percentage(sub['score'], sub['max_score'])
         if percentage >= 80:
             emoji = "🟢"
         elif percentage >= 60:
@@ -2351,7 +2565,7 @@ async def handle_student_search_code(update: Update, context: ContextTypes.DEFAU
         )
         return STUDENT_HISTORY
     
-    percentage = (sub['score'] / sub['max_score'] * 100) if sub['max_score'] > 0 else 0
+    percentage = score_percentage(sub['score'], sub['max_score'])
     if percentage >= 80:
         emoji = "🟢"
     elif percentage >= 60:
@@ -2492,7 +2706,7 @@ async def handle_manual_score_input(update: Update, context: ContextTypes.DEFAUL
     conn.close()
     
     # Show confirmation
-    percentage = (score / max_score * 100) if max_score > 0 else 0
+    percentage = score_percentage(score, max_score)
     await update.message.reply_text(
         f"✅ **Graded!**\\n\\n"
         f"Score: {score}/{int(max_score)} ({percentage:.0f}%)"
@@ -2560,6 +2774,13 @@ async def handle_skip_grade(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # NAVIGATION HANDLERS
 # ============================================================================
 
+async def still_processing(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answer input sent while the user's previous update is still being handled"""
+    if update.callback_query:
+        await update.callback_query.answer("⏳ Still processing your last request, please wait...")
+    elif update.message:
+        await update.message.reply_text("⏳ Still processing your last message, please wait...")
+
 async def back_to_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Go back to start"""
     query = update.callback_query
@@ -2586,16 +2807,10 @@ async def back_to_student_menu(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     
-    keyboard = [
-        [InlineKeyboardButton("🔍 Find Assignment", callback_data="find_assignment")],
-        [InlineKeyboardButton("⚡ Quick Grade", callback_data="quick_grade_student")],
-        [InlineKeyboardButton("🔙 Back", callback_data="back_to_start")]
-    ]
-    
     await query.edit_message_text(
         "👨‍🎓 STUDENT PORTAL\n\n"
         "What would you like to do?",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=STUDENT_MENU_MARKUP,
         parse_mode="Markdown"
     )
     
@@ -2623,25 +2838,20 @@ async def show_help_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     
-    keyboard = [[InlineKeyboardButton("🔙 Back to Start", callback_data="back_to_start")]]
-    
-    help_text = get_comprehensive_help_text()
-    
-    # Split into chunks if too long (Telegram limit)
-    chunks = [help_text[i:i+4096] for i in range(0, len(help_text), 4096)]
+    chunks = HELP_TEXT_CHUNKS
     
     for i, chunk in enumerate(chunks):
         if i == 0:
             await query.edit_message_text(
                 chunk,
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup(keyboard) if i == len(chunks) - 1 else None
+                reply_markup=HELP_BACK_MARKUP if i == len(chunks) - 1 else None
             )
         else:
             await query.message.reply_text(
                 chunk,
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup(keyboard) if i == len(chunks) - 1 else None
+                reply_markup=HELP_BACK_MARKUP if i == len(chunks) - 1 else None
             )
 
 def get_comprehensive_help_text():
@@ -2959,15 +3169,15 @@ Thank you for using Joshuazaza GradeBot! 🎓🚀
 ═══════════════════════════════════════════════════════════════
 """
 
+# The help text never changes, so split it into Telegram-sized (4096 char)
+# chunks once instead of on every /help
+_HELP_TEXT = get_comprehensive_help_text()
+HELP_TEXT_CHUNKS = [_HELP_TEXT[i:i+4096] for i in range(0, len(_HELP_TEXT), 4096)]
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show comprehensive help via /help command"""
     
-    help_text = get_comprehensive_help_text()
-    
-    # Split into chunks if too long (Telegram limit is 4096 chars)
-    chunks = [help_text[i:i+4096] for i in range(0, len(help_text), 4096)]
-    
-    for i, chunk in enumerate(chunks):
+    for chunk in HELP_TEXT_CHUNKS:
         await update.message.reply_text(chunk, parse_mode='Markdown')
 
 
@@ -2975,45 +3185,116 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors gracefully"""
+    # Timeouts and dropped connections (TimedOut is a NetworkError) are
+    # routine during long polling and PTB retries them itself
+    if isinstance(context.error, NetworkError):
+        print(f"Network error: {context.error}")
+        return
     print(f"Error: {context.error}")
+    traceback.print_exception(type(context.error), context.error, context.error.__traceback__)
 
 # ============================================================================
 # MAIN - BOT SETUP - FIXED CONVERSATION HANDLER
 # ============================================================================
 
+def _warm_tess_api(barrier):
+    """Build the calling worker's tesserocr API, then hold the thread until every worker has one"""
+    tess_api()
+    barrier.wait(timeout=60)
+
+def warm_up_models():
+    """Load embedding and OCR models at boot instead of on the first submission"""
+    started = time.perf_counter()
+    if USE_EMBEDDINGS:
+        try:
+            EMBED_MODEL.encode(["warmup"])
+        except Exception as e:
+            print(f"⚠️ Embedding warmup failed: {e}")
+    try:
+        if os.getenv("RENDER") == "true":
+            easyocr_reader()
+        elif TESSEROCR_AVAILABLE:
+            # tess_api() is per thread and OCR runs on _POOL, so build one in
+            # each worker; the barrier stops a finished worker taking a second job
+            barrier = threading.Barrier(POOL_WORKERS)
+            for future in [_POOL.submit(_warm_tess_api, barrier) for _ in range(POOL_WORKERS)]:
+                future.result()
+        else:
+            # pytesseract runs the tesseract binary per call; one run loads
+            # tessdata into the page cache
+            pytesseract.image_to_string(Image.new("L", (100, 30), 255), config="--oem 1 --psm 6")
+    except Exception as e:
+        print(f"⚠️ OCR warmup failed: {e}")
+    print(f"✅ Models warmed up in {time.perf_counter() - started:.2f}s")
+
+async def post_init(application):
+    """Configure the event loop once it is running"""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+    )
+
 def main():
     """Initialize and run bot"""
+    if UVLOOP_AVAILABLE:
+        # Must be set before the Application creates its loop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     # Initialize PostgreSQL database
     init_db()
     
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # Shared keep-alive connection pool for outgoing API calls; getUpdates
+    # long-polls on its own small pool so it never starves replies
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .request(HTTPXRequest(
+            connection_pool_size=64,
+            pool_timeout=10.0,
+            connect_timeout=10.0,
+            read_timeout=15.0,
+            write_timeout=30.0,  # room for document/photo uploads
+            http_version="1.1",
+        ))
+        # Only one getUpdates call is ever in flight; PTB adds the 50s poll
+        # timeout on top of read_timeout for it
+        .get_updates_request(HTTPXRequest(connection_pool_size=1, read_timeout=10.0))
+        # Handle each update in its own task so one slow grading request
+        # doesn't hold up everyone else's updates
+        .defaults(Defaults(block=False))
+        .persistence(PicklePersistence(filepath=STATE_FILE, update_interval=STATE_FLUSH_INTERVAL))
+        .post_init(post_init)
+        .build()
+    )
+    warm_up_models()
+    precompute_stored_answer_embeddings()
     
     # Main conversation handler - EXPANDED
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        name="main_conv",
+        persistent=True,
+        entry_points=[CommandHandler("start", start, block=False)],
         states={
             START: [
                 CallbackQueryHandler(teacher_mode_selector, pattern="^teacher_mode$"),
                 CallbackQueryHandler(direct_teacher_login, pattern="^teacher_login$"),
                 CallbackQueryHandler(student_mode, pattern="^student_mode$"),
                 CallbackQueryHandler(show_help_callback, pattern="^show_help$"),
-                CallbackQueryHandler(back_to_start, pattern="^back_to_start$"),
+                CallbackQueryHandler(back_to_start, pattern="^back_to_start$", block=False),
             ],
             TEACHER_LOGIN: [
                 CallbackQueryHandler(proceed_teacher_login, pattern="^proceed_login$"),
                 CallbackQueryHandler(proceed_teacher_register, pattern="^proceed_register$"),
-                CallbackQueryHandler(back_to_start, pattern="^back_to_start$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_teacher_auth),
+                CallbackQueryHandler(back_to_start, pattern="^back_to_start$", block=False),
+                MessageHandler(TEXT_INPUT, handle_teacher_auth),
             ],
             TEACHER_REGISTER: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_teacher_auth),
+                MessageHandler(TEXT_INPUT, handle_teacher_auth),
             ],
             TEACHER_MENU: [
                 CallbackQueryHandler(create_assignment_start, pattern="^create_assignment$"),
                 CallbackQueryHandler(quick_grade_start, pattern="^quick_grade$"),
                 CallbackQueryHandler(view_my_assignments, pattern="^my_assignments$"),
                 CallbackQueryHandler(view_results_analytics, pattern="^view_results$"),
-                CallbackQueryHandler(logout, pattern="^logout$"),
+                CallbackQueryHandler(logout, pattern="^logout$", block=False),
                 CallbackQueryHandler(back_to_teacher_menu, pattern="^teacher_menu$"),
                 CallbackQueryHandler(handle_view_assign_details, pattern="^view_assign_"),
                 CallbackQueryHandler(handle_edit_assign, pattern="^edit_assign_"),
@@ -3038,66 +3319,97 @@ def main():
                 CallbackQueryHandler(handle_edit_score, pattern="^edit_score_"),
                 CallbackQueryHandler(handle_edit_deadline, pattern="^edit_deadline_"),
                 CallbackQueryHandler(back_to_teacher_menu, pattern="^teacher_menu$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_assignment_creation),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_edit_field_text),
+                MessageHandler(TEXT_INPUT, handle_assignment_creation),
+                MessageHandler(TEXT_INPUT, handle_edit_field_text),
             ],
             STUDENT_MAIN: [
                 CallbackQueryHandler(find_assignment_start, pattern="^find_assignment$"),
                 CallbackQueryHandler(student_history_start, pattern="^my_history$"),
                 CallbackQueryHandler(quick_grade_start, pattern="^quick_grade_student$"),
                 CallbackQueryHandler(back_to_student_menu, pattern="^student_menu$"),
-                CallbackQueryHandler(back_to_start, pattern="^back_to_start$"),
+                CallbackQueryHandler(back_to_start, pattern="^back_to_start$", block=False),
             ],
             FIND_ASSIGNMENT: [
                 CallbackQueryHandler(submit_answer_handler, pattern="^submit_answer$"),
                 CallbackQueryHandler(back_to_student_menu, pattern="^student_menu$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_assignment_code),
+                MessageHandler(TEXT_INPUT, handle_assignment_code),
             ],
             STUDENT_FILL_DETAILS: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_student_fill_details),
+                MessageHandler(TEXT_INPUT, handle_student_fill_details),
             ],
             ANSWER_SUBMISSION: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, process_student_answer),
+                MessageHandler(TEXT_INPUT, process_student_answer),
                 MessageHandler(filters.VOICE, process_student_answer),  # NEW: Voice answer support
                 MessageHandler(filters.PHOTO, process_student_answer),  # NEW: Image/OCR answer support
             ],
             QUICK_GRADE_MENU: [
-                CallbackQueryHandler(back_to_start, pattern="^back_to_start$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_quick_grade),
+                CallbackQueryHandler(back_to_start, pattern="^back_to_start$", block=False),
+                MessageHandler(TEXT_INPUT, handle_quick_grade),
             ],
             STUDENT_HISTORY: [
                 CallbackQueryHandler(student_history_start, pattern="^my_history$"),
                 CallbackQueryHandler(student_search_by_code, pattern="^search_by_code$"),
                 CallbackQueryHandler(student_view_all, pattern="^view_all_subs$"),
                 CallbackQueryHandler(back_to_student_menu, pattern="^student_menu$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_student_search_code),
+                MessageHandler(TEXT_INPUT, handle_student_search_code),
             ],
             MANUAL_GRADING: [
                 CallbackQueryHandler(handle_skip_grade, pattern="^skip_grade$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_manual_score_input),
+                MessageHandler(TEXT_INPUT, handle_manual_score_input),
+            ],
+            # Handlers run non-blocking, so while one is still running for a
+            # user their conversation is pending and further input lands here
+            # instead of in the step that hasn't advanced yet
+            ConversationHandler.WAITING: [
+                CallbackQueryHandler(still_processing),
+                MessageHandler(filters.ALL, still_processing),
             ],
         },
-        fallbacks=[CommandHandler("start", start)],
+        fallbacks=[CommandHandler("start", start, block=False)],
     )
     
-    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("help", help_command, block=False))
     app.add_handler(conv_handler)
     app.add_error_handler(error_handler)
     
-    print("🚀 Advanced Exam Grading Bot v2 - PostgreSQL Edition is ONLINE!")
-    print("✅ Database: PostgreSQL (Render Cloud)")
-    print("✅ Features: Teacher Accounts | Dynamic Questions | Student Answers")
-    print("✅ Features: Quick Grading | Customizable Scales | Proper Navigation")
-    print("✅ NEW: PostgreSQL database for better performance and reliability!")
-    print("✅ FIXED: Teacher login now working properly!")
-    print("✅ NEW: Assignment Deadlines | Student Details | Color-Coded Scores")
-    print("✅ NEW: View All Submissions | Export to Excel")
-    print("✅ FIXED: Required fields collection now working perfectly!")
-    print("✅ FIXED: Export to Excel now working with proper callback patterns!")
-    print("✅ FIXED: Pandas compatibility with Python 3.13!")
-    print("\n📍 Waiting for users...\n")
-    
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # One write for the whole banner
+    print(
+        "🚀 Advanced Exam Grading Bot v2 - PostgreSQL Edition is ONLINE!\n"
+        "✅ Database: PostgreSQL (Render Cloud)\n"
+        "✅ Features: Teacher Accounts | Dynamic Questions | Student Answers\n"
+        "✅ Features: Quick Grading | Customizable Scales | Proper Navigation\n"
+        "✅ NEW: PostgreSQL database for better performance and reliability!\n"
+        "✅ FIXED: Teacher login now working properly!\n"
+        "✅ NEW: Assignment Deadlines | Student Details | Color-Coded Scores\n"
+        "✅ NEW: View All Submissions | Export to Excel\n"
+        "✅ FIXED: Required fields collection now working perfectly!\n"
+        "✅ FIXED: Export to Excel now working with proper callback patterns!\n"
+        "✅ FIXED: Pandas compatibility with Python 3.13!\n"
+        "\n📍 Waiting for users...\n",
+        flush=True
+    )
+    
+    if WEBHOOK_URL:
+        print(f"🌐 Receiving updates via webhook at {WEBHOOK_URL}/{WEBHOOK_PATH}")
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY],
+            bootstrap_retries=-1,
+        )
+        return
+    
+    # Long-poll for up to 50s (under Telegram's 60s cap) so an idle bot makes
+    # one getUpdates call a minute, and fetch again right away after a batch
+    app.run_polling(
+        allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY],
+        timeout=50,
+        poll_interval=0.0,
+        bootstrap_retries=-1,
+    )
 
 if __name__ == "__main__":
     main()
@@ -6,36 +6,46 @@
 # ============================================================================
 
 import os
-import re
 import sys
 import json
-import hashlib
+import functools
+import asyncio
 import sqlite3
-import uuid
+import threading
+import time
+import traceback
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from PIL import Image
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, filters, 
-    ContextTypes, ConversationHandler, CallbackQueryHandler
+    ContextTypes, ConversationHandler, CallbackQueryHandler, Defaults, PicklePersistence
 )
+from telegram.request import HTTPXRequest
+from telegram.error import NetworkError
+from telegram.helpers import escape_markdown
 from dotenv import load_dotenv
 
+from grading_common import (
+    USE_EMBEDDINGS, EMBED_MODEL, hash_password, verify_password, new_id,
+    generate_assignment_code, get_cached_teacher, store_teacher, forget_teacher,
+    score_percentage, normalize_text, normalize_expected, embed_text,
+    precompute_answer_embeddings, count_keyword_matches, semantic_score
+)
+
 sqlite3.register_adapter(datetime, lambda val: val.isoformat() if val else None)
 
-USE_EMBEDDINGS = False
-EMBED_MODEL = None
+load_dotenv()
 
+# libuv-based event loop (not available on Windows)
 try:
-    from sentence_transformers import SentenceTransformer, util
-    EMBED_MODEL = SentenceTransformer('all-MiniLM-L6-v2')
-    USE_EMBEDDINGS = True
-except:
-    pass
-
-load_dotenv()
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
 
 # ============================================================================
 # CONFIG
@@ -44,28 +54,187 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 SUPER_ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 
+# Webhook mode: set WEBHOOK_URL to the bot's public https base URL and
+# Telegram pushes updates to PORT instead of the bot long-polling for them
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+
+# Conversation state and user_data survive restarts in this file; PTB
+# flushes it every STATE_FLUSH_INTERVAL seconds rather than per update
+STATE_FILE = os.getenv("STATE_FILE", "grade_bot_state.pkl")
+STATE_FLUSH_INTERVAL = 5
+PORT = int(os.getenv("PORT", "8443"))
+
 if not TELEGRAM_TOKEN:
     print("ERROR: TELEGRAM_TOKEN missing in environment!")
     print("Please add TELEGRAM_TOKEN to your secrets.")
     sys.exit(1)
 
+# Worker pool for blocking OCR / embedding work, so the event loop keeps
+# serving other users while one submission is being graded
+_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+# Bounded pool behind asyncio.to_thread for short DB calls and hashing, kept
+# apart from _POOL so a grading burst never queues ahead of a login lookup
+DB_WORKERS = 8
+
 # Conversation states
 (START, TEACHER_LOGIN, TEACHER_REGISTER, TEACHER_MENU, CREATE_QUESTION,
  STUDENT_MAIN, FIND_ASSIGNMENT, ANSWER_SUBMISSION, QUICK_GRADE_MENU,
  QUICK_GRADE_SETUP, QUICK_GRADE_ANSWER, TEACHER_DASHBOARD) = range(12)
 
+# Plain typed text (not a /command); one filter object shared by every text state
+TEXT_INPUT = filters.TEXT & ~filters.COMMAND
+
+# Menus that never change are built once instead of on every button press
+TEACHER_MENU_TEXT = "**TEACHER DASHBOARD**\n\nWelcome, {name}!\n\nWhat would you like to do?"
+TEACHER_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Create Assignment", callback_data="create_assignment")],
+    [InlineKeyboardButton("My Assignments", callback_data="my_assignments")],
+    [InlineKeyboardButton("Quick Grade", callback_data="quick_grade")],
+    [InlineKeyboardButton("Results & Analytics", callback_data="view_results")],
+    [InlineKeyboardButton("Logout", callback_data="logout")]
+])
+
+STUDENT_MENU_TEXT = "**STUDENT PORTAL**\n\nWhat would you like to do?"
+STUDENT_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Find Assignment", callback_data="find_assignment")],
+    [InlineKeyboardButton("Quick Grade", callback_data="quick_grade_student")],
+    [InlineKeyboardButton("Back", callback_data="back_to_start")]
+])
+
+ROLE_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Teacher Account", callback_data="teacher_mode")],
+    [InlineKeyboardButton("Student", callback_data="student_mode")]
+])
+# /start variant for users who already have a teacher account
+ROLE_LOGIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Login to Teacher Account", callback_data="teacher_login")],
+    [InlineKeyboardButton("Student", callback_data="student_mode")]
+])
+
+BACK_TO_START_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Back", callback_data="back_to_start")]])
+BACK_TO_TEACHER_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Back", callback_data="teacher_menu")]])
+BACK_TO_STUDENT_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Back", callback_data="student_menu")]])
+
+QUICK_GRADE_RESULT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Grade Another", callback_data="quick_grade")],
+    [InlineKeyboardButton("Back", callback_data="back_to_start")]
+])
+
+QUESTION_TYPE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Short Answer", callback_data="type_short")],
+    [InlineKeyboardButton("Exact Match", callback_data="type_exact")],
+    [InlineKeyboardButton("Keyword Based", callback_data="type_keyword")],
+    [InlineKeyboardButton("AI Semantic", callback_data="type_semantic")],
+])
+
+HELP_TEXT = """
+**EXAM GRADING BOT - HELP GUIDE**
+
+**FOR TEACHERS:**
+1. Click /start and select "Teacher Mode"
+2. Register with your name, username, and password
+3. Create assignments with unique codes
+4. Share codes with students
+5. View results and analytics
+
+**FOR STUDENTS:**
+1. Click /start and select "Student"
+2. Enter assignment code from teacher
+3. Submit your answer
+4. Get instant grading
+
+**QUICK GRADE:**
+- Grade any answer instantly
+- No login required
+- Great for quick checks
+
+**COMMANDS:**
+/start - Start the bot
+/help - Show this help
+
+Need more help? Contact your teacher or administrator.
+"""
+
+# Upper bounds on typed input, so one message can't bloat a DB row or push
+# an echoing reply past Telegram's 4096 character limit
+MAX_NAME_LEN = 100
+MAX_USERNAME_LEN = 40
+MAX_TITLE_LEN = 120
+MAX_QUESTION_LEN = 2000
+MAX_ANSWER_LEN = 2000
+MAX_QUICK_GRADE_LEN = 1000  # question, correct and student answer are all echoed back
+
+# Steps that just store the reply and prompt for the next one, looked up by
+# handle_text_step: step -> (user_data key, max length, prompt, reply_markup, next step)
+REGISTER_STEPS = {
+    'register_name': ('reg_name', MAX_NAME_LEN, "Step 2: Choose a username (for login)", None, 'register_username'),
+    'register_username': ('reg_username', MAX_USERNAME_LEN, "Step 3: Create a password", None, 'register_password'),
+}
+# 'question' keeps its step until a type button is pressed
+ASSIGNMENT_STEPS = {
+    'title': ('assign_title', MAX_TITLE_LEN, "Step 2: Enter the question/assignment text", None, 'question'),
+    'question': ('assign_question', MAX_QUESTION_LEN, "Step 3: Choose question type", QUESTION_TYPE_MARKUP, None),
+    'answer': ('assign_answer', MAX_ANSWER_LEN, "Step 5: Enter the maximum score (e.g., 5, 10, 20, 100)", None, 'max_score'),
+}
+QUICK_GRADE_STEPS = {
+    'question': ('qg_question', MAX_QUICK_GRADE_LEN, "Step 2: Enter the correct answer(s)", None, 'correct_answer'),
+    'correct_answer': ('qg_correct', MAX_QUICK_GRADE_LEN, "Step 3: Enter the student's answer", None, 'student_answer'),
+    'student_answer': ('qg_student_answer', MAX_QUICK_GRADE_LEN, "Step 4: Enter max score (e.g., 5, 10, 20, 100)", None, 'max_score'),
+}
+
 # ============================================================================
 # DATABASE SETUP
 # ============================================================================
 
+DB_PATH = "exam_data.db"
+
+# Shared autocommit connection for the short queries on hot paths (auth,
+# assignment lookup, submissions), instead of opening a connection per call.
+# Used from several threads, so every use holds DB_LOCK.
+DB_CONN = None
+DB_LOCK = threading.Lock()
+
+# Hot-path statements, defined once so every call hands sqlite3 the same
+# string and hits the connection's statement cache
+SQL_INSERT_TEACHER = "INSERT INTO teachers (telegram_id, username, password, salt, full_name, grading_scale, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)"
+SQL_SELECT_TEACHER_LOGIN = "SELECT teacher_id, full_name, password, salt, grading_scale FROM teachers WHERE username=?"
+SQL_UPDATE_TEACHER_PASSWORD = "UPDATE teachers SET password=?, salt=? WHERE teacher_id=?"
+SQL_SELECT_TEACHER_BY_TELEGRAM = "SELECT teacher_id, full_name, grading_scale FROM teachers WHERE telegram_id=?"
+SQL_SELECT_TEACHER_SCALE = "SELECT grading_scale FROM teachers WHERE teacher_id=?"
+SQL_SELECT_TEACHER_ASSIGNMENTS = "SELECT assignment_id, code, title, question, question_type, max_score, created_at FROM assignments WHERE teacher_id=? ORDER BY created_at DESC"
+SQL_INSERT_ASSIGNMENT = "INSERT INTO assignments (assignment_id, teacher_id, code, title, question, question_type, max_score, grading_scale, created_at, answers) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+SQL_SELECT_ASSIGNMENT_BY_CODE = "SELECT assignment_id, title, question, question_type, max_score, grading_scale, answers FROM assignments WHERE code=?"
+SQL_SELECT_ASSIGNMENT_SUBMISSIONS = "SELECT submission_id, student_name, student_id, answer, score, max_score, submitted_at FROM submissions WHERE assignment_id=? ORDER BY submitted_at DESC"
+SQL_INSERT_SUBMISSION = "INSERT INTO submissions (submission_id, assignment_id, student_name, student_id, answer, score, max_score, submitted_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+SQL_INSERT_QUICK_GRADE = "INSERT INTO quick_grades (grade_id, teacher_id, question, answer_given, score, max_score, graded_at) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+def get_db_connection(**kwargs):
+    """Open a SQLite connection tuned for many short reads/writes"""
+    conn = sqlite3.connect(DB_PATH, cached_statements=256, **kwargs)
+    # WAL (set once in init_db) keeps readers unblocked during submission
+    # writes; NORMAL sync is safe under WAL and avoids an fsync per commit
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-65536")
+    return conn
+
 def init_db():
     """Initialize SQLite database with teacher accounts"""
-    conn = sqlite3.connect("exam_data.db")
+    conn = get_db_connection()
     c = conn.cursor()
+    c.execute("PRAGMA journal_mode=WAL")
     
     c.execute('''CREATE TABLE IF NOT EXISTS teachers
         (teacher_id INTEGER PRIMARY KEY, telegram_id INT UNIQUE, username TEXT UNIQUE,
-         password TEXT, full_name TEXT, created_at TIMESTAMP, grading_scale INT DEFAULT 100)''')
+         password TEXT, full_name TEXT, created_at TIMESTAMP, grading_scale INT DEFAULT 100,
+         salt TEXT)''')
+    try:
+        c.execute("ALTER TABLE teachers ADD COLUMN salt TEXT")
+    except sqlite3.OperationalError:
+        pass  # column already exists
     
     c.execute('''CREATE TABLE IF NOT EXISTS assignments
         (assignment_id TEXT PRIMARY KEY, teacher_id INT, code TEXT UNIQUE,
@@ -84,98 +253,246 @@ def init_db():
          answer_given TEXT, score REAL, max_score INT,
          graded_at TIMESTAMP, FOREIGN KEY(teacher_id) REFERENCES teachers(teacher_id))''')
     
+    # code, username and telegram_id are UNIQUE and already indexed; these
+    # cover the per-assignment submission and per-teacher assignment lookups
+    c.execute("CREATE INDEX IF NOT EXISTS idx_submissions_assignment ON submissions(assignment_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_assignments_teacher ON assignments(teacher_id, created_at)")
+    # Refresh planner statistics so the indexes get used
+    c.execute("PRAGMA optimize")
+    
     conn.commit()
+    
+    global DB_CONN
+    DB_CONN = get_db_connection(check_same_thread=False, isolation_level=None)
     return conn
 
 # ============================================================================
 # HELPER FUNCTIONS
 # ============================================================================
 
-def hash_password(password):
-    """Hash password for security"""
-    return hashlib.sha256(password.encode()).hexdigest()
-
-def generate_assignment_code():
-    """Generate unique assignment code"""
-    return str(uuid.uuid4())[:8].upper()
-
-def register_teacher(telegram_id, username, password, full_name, grading_scale=100):
-    """Register new teacher"""
-    conn = sqlite3.connect("exam_data.db")
-    c = conn.cursor()
-    
+def register_teacher(telegram_id, username, hashed_pass, salt, full_name, grading_scale=100):
+    """Register new teacher with a password already hashed by hash_password"""
     try:
-        hashed_pass = hash_password(password)
-        c.execute('''INSERT INTO teachers (telegram_id, username, password, full_name, grading_scale, created_at)
-                     VALUES (?, ?, ?, ?, ?, ?)''',
-                  (telegram_id, username, hashed_pass, full_name, grading_scale, datetime.now()))
-        conn.commit()
-        teacher_id = c.lastrowid
-        return True, teacher_id
+        with DB_LOCK:
+            c = DB_CONN.execute(SQL_INSERT_TEACHER,
+                              (telegram_id, username, hashed_pass, salt, full_name, grading_scale, datetime.now()))
+        forget_teacher(telegram_id)
+        return True, c.lastrowid
     except sqlite3.IntegrityError:
         return False, None
-    finally:
-        conn.close()
 
 def login_teacher(username, password):
-    """Login teacher and return teacher_id"""
-    conn = sqlite3.connect("exam_data.db")
-    c = conn.cursor()
-    
-    hashed_pass = hash_password(password)
-    c.execute("SELECT teacher_id, full_name FROM teachers WHERE username=? AND password=?",
-              (username, hashed_pass))
-    result = c.fetchone()
-    conn.close()
-    
-    return result if result else (None, None)
+    """Login teacher and return (teacher_id, full_name, grading_scale)"""
+    with DB_LOCK:
+        row = DB_CONN.execute(SQL_SELECT_TEACHER_LOGIN, (username,)).fetchone()
+    if not row or not verify_password(password, row[2], row[3]):
+        return None, None, None
+    
+    teacher_id, full_name, _, salt, grading_scale = row
+    if not salt:
+        # Legacy SHA-256 account: upgrade to scrypt now that we have the password
+        hashed_pass, salt = hash_password(password)
+        with DB_LOCK:
+            DB_CONN.execute(SQL_UPDATE_TEACHER_PASSWORD, (hashed_pass, salt, teacher_id))
+    return teacher_id, full_name, grading_scale
 
 def login_teacher_by_telegram_id(telegram_id):
     """Login teacher by telegram ID (auto-login for existing accounts)"""
-    conn = sqlite3.connect("exam_data.db")
-    c = conn.cursor()
-    c.execute("SELECT teacher_id, full_name FROM teachers WHERE telegram_id=?", (telegram_id,))
-    result = c.fetchone()
-    conn.close()
+    with DB_LOCK:
+        result = DB_CONN.execute("SELECT teacher_id, full_name FROM teachers WHERE telegram_id=?",
+                                 (telegram_id,)).fetchone()
     return result if result else (None, None)
 
 def teacher_exists_by_telegram(telegram_id):
-    """Check if teacher account exists"""
-    conn = sqlite3.connect("exam_data.db")
-    c = conn.cursor()
-    c.execute("SELECT teacher_id, full_name FROM teachers WHERE telegram_id=?", (telegram_id,))
-    result = c.fetchone()
-    conn.close()
-    return result
+    """Check if teacher account exists, returns (teacher_id, full_name, grading_scale) or None"""
+    found, row = get_cached_teacher(telegram_id)
+    if found:
+        return row
+    with DB_LOCK:
+        row = DB_CONN.execute(SQL_SELECT_TEACHER_BY_TELEGRAM, (telegram_id,)).fetchone()
+    store_teacher(telegram_id, row)
+    return row
+
+# A teacher's assignment list only changes through create_assignment, which
+# drops the entry; the TTL just bounds memory for teachers who went idle
+ASSIGNMENTS_CACHE_TTL = 300
+_ASSIGNMENTS_CACHE = {}
+_ASSIGNMENTS_CACHE_LOCK = threading.Lock()
 
 def get_teacher_assignments(teacher_id):
     """Get all assignments for a teacher"""
-    conn = sqlite3.connect("exam_data.db")
-    c = conn.cursor()
-    c.execute('''SELECT assignment_id, code, title, question, question_type, max_score, created_at 
-                 FROM assignments WHERE teacher_id=? ORDER BY created_at DESC''', (teacher_id,))
-    results = c.fetchall()
-    conn.close()
+    now = time.monotonic()
+    with _ASSIGNMENTS_CACHE_LOCK:
+        hit = _ASSIGNMENTS_CACHE.get(teacher_id)
+        if hit and hit[0] > now:
+            return hit[1]
+        # Sweep expired entries while we hold the lock anyway
+        for key in [k for k, (expires, _) in _ASSIGNMENTS_CACHE.items() if expires <= now]:
+            del _ASSIGNMENTS_CACHE[key]
+    with DB_LOCK:
+        results = DB_CONN.execute(SQL_SELECT_TEACHER_ASSIGNMENTS, (teacher_id,)).fetchall()
+    with _ASSIGNMENTS_CACHE_LOCK:
+        _ASSIGNMENTS_CACHE[teacher_id] = (now + ASSIGNMENTS_CACHE_TTL, results)
     return results
 
 def get_assignment_submissions(assignment_id):
-    """Get all submissions for an assignment"""
-    conn = sqlite3.connect("exam_data.db")
+    """Get all submissions for an assignment (not cached, they change with every student)"""
+    with DB_LOCK:
+        return DB_CONN.execute(SQL_SELECT_ASSIGNMENT_SUBMISSIONS, (assignment_id,)).fetchall()
+
+def get_teacher_grading_scale(teacher_id):
+    """Get a teacher's grading scale (100 if unknown)"""
+    with DB_LOCK:
+        result = DB_CONN.execute(SQL_SELECT_TEACHER_SCALE, (teacher_id,)).fetchone()
+    return result[0] if result else 100
+
+def create_assignment(teacher_id, title, question, question_type, max_score, grading_scale, answers):
+    """Insert a new assignment and return its code"""
+    assignment_id = new_id()
+    code = generate_assignment_code()
+    with DB_LOCK:
+        DB_CONN.execute(SQL_INSERT_ASSIGNMENT,
+                      (assignment_id, teacher_id, code, title, question,
+                       question_type, max_score, grading_scale, datetime.now(), answers))
+    # Drop cached misses in case a student tried this code before it existed
+    get_assignment_by_code.cache_clear()
+    with _ASSIGNMENTS_CACHE_LOCK:
+        _ASSIGNMENTS_CACHE.pop(teacher_id, None)
+    return code
+
+# Assignments are never edited in this bot, so a row fetched by code stays
+# valid; a whole class looks up the same code within minutes
+@functools.lru_cache(maxsize=1024)
+def get_assignment_by_code(code):
+    """Get assignment (id, title, question, type, max_score, scale, answers) by code"""
+    with DB_LOCK:
+        return DB_CONN.execute(SQL_SELECT_ASSIGNMENT_BY_CODE, (code,)).fetchone()
+
+# Submission and quick-grade rows are queued and written by db_writer in
+# batches, so a whole class submitting at once costs one commit per batch
+# instead of one per student
+WRITE_QUEUE = asyncio.Queue()
+WRITE_BATCH_SIZE = 50
+WRITE_FLUSH_INTERVAL = 0.1
+# A failed batch (locked database, disk error) is retried with doubling
+# delays before falling back to row-by-row writes
+WRITE_RETRIES = 5
+WRITE_RETRY_DELAY = 0.5
+WRITER_TASK = None
+
+def queue_submission(assignment_id, student_name, student_id, answer, score, max_score):
+    """Queue a graded student submission for db_writer"""
+    WRITE_QUEUE.put_nowait((SQL_INSERT_SUBMISSION,
+                          (new_id(), assignment_id, student_name, student_id, answer, score, max_score, datetime.now())))
+
+def queue_quick_grade(teacher_id, question, answer_given, score, max_score):
+    """Queue a quick-grade result for db_writer"""
+    WRITE_QUEUE.put_nowait((SQL_INSERT_QUICK_GRADE,
+                          (new_id(), teacher_id, question, answer_given, score, max_score, datetime.now())))
+
+def write_rows(rows):
+    """Insert queued (sql, params) rows in a single transaction"""
+    by_sql = {}
+    for sql, params in rows:
+        by_sql.setdefault(sql, []).append(params)
+    with DB_LOCK:
+        DB_CONN.execute("BEGIN")
+        try:
+            for sql, params in by_sql.items():
+                DB_CONN.executemany(sql, params)
+            DB_CONN.execute("COMMIT")
+        except Exception:
+            # The shared connection is in autocommit mode; never leave it
+            # inside a half-finished transaction (sqlite may already have
+            # rolled back on its own after an I/O error)
+            if DB_CONN.in_transaction:
+                DB_CONN.execute("ROLLBACK")
+            raise
+
+async def flush_batch(batch):
+    """Write a batch of queued rows, retrying with backoff and logging any row that can't be saved"""
+    delay = WRITE_RETRY_DELAY
+    for attempt in range(1, WRITE_RETRIES + 1):
+        try:
+            await asyncio.to_thread(write_rows, batch)
+            return
+        except sqlite3.IntegrityError as e:
+            # A bad row fails the same way every time, don't retry the batch
+            print(f"Queued batch of {len(batch)} rows rejected: {e}")
+            break
+        except Exception as e:
+            print(f"Failed to write {len(batch)} queued rows (attempt {attempt}/{WRITE_RETRIES}): {e}")
+            if attempt < WRITE_RETRIES:
+                await asyncio.sleep(delay)
+                delay *= 2
+    
+    # Save what we can one row at a time so one bad row doesn't sink the rest
+    failed, error = [], None
+    for row in batch:
+        try:
+            await asyncio.to_thread(write_rows, [row])
+        except Exception as e:
+            failed.append(row)
+            error = e
+    if failed:
+        ids = ", ".join(f"{sql.split()[2]}:{params[0]}" for sql, params in failed)
+        print(f"LOST {len(failed)} queued rows: {ids}")
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+async def db_writer():
+    """Drain WRITE_QUEUE, committing up to WRITE_BATCH_SIZE rows per WRITE_FLUSH_INTERVAL"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await WRITE_QUEUE.get()]
+        deadline = loop.time() + WRITE_FLUSH_INTERVAL
+        while len(batch) < WRITE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(WRITE_QUEUE.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await flush_batch(batch)
+        finally:
+            for _ in batch:
+                WRITE_QUEUE.task_done()
+
+async def reject_long_input(message, text, limit):
+    """Ask for a shorter reply if text is over limit, returns True when rejected"""
+    if len(text) <= limit:
+        return False
+    await message.reply_text(f"That's too long ({len(text)} characters, max {limit}). Please send a shorter one:")
+    return True
+
+async def handle_text_step(update, context, steps, step_field):
+    """Run a simple text step from a *_STEPS table, returns False if the current step isn't in it"""
+    entry = steps.get(context.user_data.get(step_field))
+    if entry is None:
+        return False
+    key, limit, prompt, reply_markup, next_step = entry
+    text = update.message.text.strip()
+    if limit and await reject_long_input(update.message, text, limit):
+        return True
+    context.user_data[key] = text
+    await update.message.reply_text(prompt, reply_markup=reply_markup)
+    if next_step:
+        context.user_data[step_field] = next_step
+    return True
+
+def precompute_stored_answer_embeddings():
+    """Encode the expected answers of existing AI Semantic assignments"""
+    if not USE_EMBEDDINGS:
+        return
+    conn = get_db_connection()
     c = conn.cursor()
-    c.execute('''SELECT submission_id, student_name, student_id, answer, score, max_score, submitted_at 
-                 FROM submissions WHERE assignment_id=? ORDER BY submitted_at DESC''', (assignment_id,))
-    results = c.fetchall()
+    c.execute("SELECT answers FROM assignments WHERE question_type='AI Semantic' "
+              "ORDER BY created_at DESC LIMIT 1024")
+    answers = [row[0] for row in c.fetchall()]
     conn.close()
-    return results
-
-def normalize_text(s):
-    """Normalize text"""
-    if not s:
-        return ""
-    s = str(s).lower().strip()
-    s = re.sub(r'[^a-z0-9\s]', ' ', s)
-    s = re.sub(r'\s+', ' ', s)
-    return s
+    precompute_answer_embeddings(answers)
+    print(f"Precomputed {len(answers)} answer embeddings")
 
 # ============================================================================
 # GRADING FUNCTIONS
@@ -184,46 +501,46 @@ def normalize_text(s):
 def grade_answer(student_answer, expected_answer, max_score, question_type="short"):
     """Grade student answer"""
     sa = normalize_text(student_answer)
-    ea = normalize_text(expected_answer)
+    ea = normalize_expected(expected_answer)
     
     if question_type == "exact" or question_type == "exactmatch":
         score = max_score if sa == ea else 0
         detail = "Exact match!" if score == max_score else "Incorrect"
     
     elif question_type == "keyword" or question_type == "keywordbased":
-        keywords = ea.split()
-        if keywords:
-            matched = sum(1 for kw in keywords if kw in sa)
-            score = int((matched / len(keywords) * max_score))
-            detail = f"Matched {matched}/{len(keywords)} keywords"
+        matched, total = count_keyword_matches(sa, ea)
+        if total:
+            score = int((matched / total * max_score))
+            detail = f"Matched {matched}/{total} keywords"
         else:
             score = 0
             detail = "No keywords to match"
     
     elif (question_type == "semantic" or question_type == "aisemantic") and USE_EMBEDDINGS:
-        try:
-            student_emb = EMBED_MODEL.encode(sa, convert_to_tensor=True)
-            expected_emb = EMBED_MODEL.encode(ea, convert_to_tensor=True)
-            similarity = float(util.cos_sim(student_emb, expected_emb))
-            if similarity > 0.8:
-                score = max_score
-            elif similarity > 0.6:
-                score = int(max_score * 0.7)
-            elif similarity > 0.4:
-                score = int(max_score * 0.4)
-            else:
-                score = 0
-            detail = f"Semantic match: {similarity:.2f}"
-        except:
+        # Cheap paths first: an identical or empty answer needs no model call
+        if sa == ea:
+            score = max_score
+            detail = "Exact match!"
+        elif not sa:
             score = 0
-            detail = "AI grading failed"
+            detail = "No answer given"
+        else:
+            try:
+                student_emb = embed_text(sa)
+                expected_emb = embed_text(ea)
+                # Embeddings are unit length, so the dot product is the cosine similarity
+                similarity = float(student_emb @ expected_emb)
+                score = semantic_score(similarity, max_score)
+                detail = f"Semantic match: {similarity:.2f}"
+            except:
+                score = 0
+                detail = "AI grading failed"
     
     else:
-        keywords = ea.split()
-        if keywords:
-            matched = sum(1 for kw in keywords if kw in sa)
-            score = int((matched / len(keywords) * max_score))
-            detail = f"Matched {matched}/{len(keywords)} keywords"
+        matched, total = count_keyword_matches(sa, ea)
+        if total:
+            score = int((matched / total * max_score))
+            detail = f"Matched {matched}/{total} keywords"
         else:
             score = 0
             detail = "Manual grading needed"
@@ -234,6 +551,10 @@ def grade_answer(student_answer, expected_answer, max_score, question_type="shor
 # TELEGRAM HANDLERS - MAIN FLOW
 # ============================================================================
 
+async def answer_and_edit(query, text, **kwargs):
+    """Ack a button press and edit its message concurrently rather than in two round-trips"""
+    await asyncio.gather(query.answer(), query.edit_message_text(text, **kwargs))
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command - Check if teacher exists"""
     user_id = update.message.from_user.id
@@ -241,20 +562,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     context.user_data.clear()
     
-    teacher_info = teacher_exists_by_telegram(user_id)
-    
-    keyboard = [
-        [InlineKeyboardButton("Teacher Account", callback_data="teacher_mode")],
-        [InlineKeyboardButton("Student", callback_data="student_mode")]
-    ]
-    
-    if teacher_info:
-        keyboard[0][0] = InlineKeyboardButton("Login to Teacher Account", callback_data="teacher_login")
+    teacher_info = await asyncio.to_thread(teacher_exists_by_telegram, user_id)
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = ROLE_LOGIN_MENU_MARKUP if teacher_info else ROLE_MENU_MARKUP
     
     await update.message.reply_text(
-        f"Welcome {user_name}!\n\n"
+        f"Welcome {escape_markdown(user_name)}!\n\n"
         "**Smart Exam & Assignment System**\n\n"
         "Choose your role:",
         reply_markup=reply_markup,
@@ -270,10 +583,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def teacher_mode_selector(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Teacher: Register or Login - For new users"""
     query = update.callback_query
-    await query.answer()
-    
     user_id = query.from_user.id
-    teacher_info = teacher_exists_by_telegram(user_id)
+    # Ack the button while the lookup runs instead of one after the other
+    _, teacher_info = await asyncio.gather(
+        query.answer(), asyncio.to_thread(teacher_exists_by_telegram, user_id)
+    )
     
     if teacher_info:
         keyboard = [
@@ -305,22 +619,23 @@ async def teacher_mode_selector(update: Update, context: ContextTypes.DEFAULT_TY
 async def teacher_login_selector(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Teacher: Direct login for existing users"""
     query = update.callback_query
-    await query.answer()
-    
     user_id = query.from_user.id
-    teacher_info = teacher_exists_by_telegram(user_id)
+    _, teacher_info = await asyncio.gather(
+        query.answer(), asyncio.to_thread(teacher_exists_by_telegram, user_id)
+    )
     
     if teacher_info:
-        teacher_id, full_name = teacher_info
+        teacher_id, full_name, grading_scale = teacher_info
         context.user_data['teacher_id'] = teacher_id
         context.user_data['full_name'] = full_name
+        context.user_data['grading_scale'] = grading_scale
         
+        # The dashboard already greets the teacher, so edit straight into it
         await query.edit_message_text(
-            f"Welcome back, {full_name}!\n\n"
-            "Loading teacher menu..."
+            TEACHER_MENU_TEXT.format(name=escape_markdown(full_name)),
+            reply_markup=TEACHER_MENU_MARKUP,
+            parse_mode="Markdown"
         )
-        
-        await show_teacher_menu_from_callback(query, context)
         return TEACHER_MENU
     else:
         keyboard = [
@@ -339,22 +654,23 @@ async def teacher_login_selector(update: Update, context: ContextTypes.DEFAULT_T
 async def proceed_teacher_login(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Login flow - username/password"""
     query = update.callback_query
-    await query.answer()
-    
     user_id = query.from_user.id
-    teacher_info = teacher_exists_by_telegram(user_id)
+    _, teacher_info = await asyncio.gather(
+        query.answer(), asyncio.to_thread(teacher_exists_by_telegram, user_id)
+    )
     
     if teacher_info:
-        teacher_id, full_name = teacher_info
+        teacher_id, full_name, grading_scale = teacher_info
         context.user_data['teacher_id'] = teacher_id
         context.user_data['full_name'] = full_name
+        context.user_data['grading_scale'] = grading_scale
         
+        # The dashboard already greets the teacher, so edit straight into it
         await query.edit_message_text(
-            f"Welcome back, {full_name}!\n\n"
-            "Loading teacher menu..."
+            TEACHER_MENU_TEXT.format(name=escape_markdown(full_name)),
+            reply_markup=TEACHER_MENU_MARKUP,
+            parse_mode="Markdown"
         )
-        
-        await show_teacher_menu_from_callback(query, context)
         return TEACHER_MENU
     else:
         await query.edit_message_text(
@@ -368,9 +684,8 @@ async def proceed_teacher_login(update: Update, context: ContextTypes.DEFAULT_TY
 async def proceed_teacher_register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Register flow"""
     query = update.callback_query
-    await query.answer()
-    
-    await query.edit_message_text(
+    await answer_and_edit(
+        query,
         "**CREATE ACCOUNT**\n\n"
         "Step 1: Enter your full name",
         parse_mode="Markdown"
@@ -402,18 +717,15 @@ async def handle_teacher_auth(update: Update, context: ContextTypes.DEFAULT_TYPE
         username = context.user_data.get('login_username')
         password = text
         
-        teacher_id, full_name = login_teacher(username, password)
+        teacher_id, full_name, grading_scale = await asyncio.to_thread(login_teacher, username, password)
         
         if teacher_id:
             context.user_data['teacher_id'] = teacher_id
             context.user_data['full_name'] = full_name
+            context.user_data['grading_scale'] = grading_scale
             context.user_data['auth_step'] = None
             
-            await update.message.reply_text(
-                f"Welcome back, {full_name}!\n\n"
-                "Loading teacher menu..."
-            )
-            await show_teacher_menu(update, context)
+            await show_teacher_menu(update.message, context)
             return TEACHER_MENU
         else:
             keyboard = [
@@ -444,52 +756,48 @@ async def handle_teacher_register(update: Update, context: ContextTypes.DEFAULT_
         )
         return TEACHER_REGISTER
     
-    if auth_step == 'register_name':
-        context.user_data['reg_name'] = text
-        await update.message.reply_text("Step 2: Choose a username (for login)")
-        context.user_data['auth_step'] = 'register_username'
-        return TEACHER_REGISTER
-    
-    elif auth_step == 'register_username':
-        context.user_data['reg_username'] = text
-        await update.message.reply_text("Step 3: Create a password")
-        context.user_data['auth_step'] = 'register_password'
+    if await handle_text_step(update, context, REGISTER_STEPS, 'auth_step'):
         return TEACHER_REGISTER
     
-    elif auth_step == 'register_password':
-        context.user_data['reg_password'] = text
+    if auth_step == 'register_password':
+        # Only the scrypt hash is kept in user_data, which is persisted to disk
+        context.user_data['reg_password_hash'], context.user_data['reg_salt'] = await asyncio.to_thread(hash_password, text)
         await update.message.reply_text("Step 4: Choose your grading scale (e.g., 5, 10, 20, 30, 100)")
         context.user_data['auth_step'] = 'register_scale'
         return TEACHER_REGISTER
     
-    elif auth_step == 'register_scale':
+    if auth_step == 'register_scale':
         try:
             scale = int(text)
             if scale < 1 or scale > 100:
                 await update.message.reply_text("Scale must be between 1-100. Try again:")
                 return TEACHER_REGISTER
             
-            success, teacher_id = register_teacher(
+            success, teacher_id = await asyncio.to_thread(
+                register_teacher,
                 user_id,
                 context.user_data['reg_username'],
-                context.user_data['reg_password'],
+                context.user_data['reg_password_hash'],
+                context.user_data['reg_salt'],
                 context.user_data['reg_name'],
                 scale
             )
             
             if success:
+                context.user_data.pop('reg_password_hash', None)
+                context.user_data.pop('reg_salt', None)
                 context.user_data['teacher_id'] = teacher_id
                 context.user_data['full_name'] = context.user_data['reg_name']
+                context.user_data['grading_scale'] = scale
                 context.user_data['auth_step'] = None
                 
-                await update.message.reply_text(
-                    f"Account created successfully!\n\n"
-                    f"Name: {context.user_data['reg_name']}\n"
-                    f"Username: {context.user_data['reg_username']}\n"
+                await show_teacher_menu(
+                    update.message, context,
+                    header=f"Account created successfully!\n\n"
+                    f"Name: {escape_markdown(context.user_data['reg_name'])}\n"
+                    f"Username: {escape_markdown(context.user_data['reg_username'])}\n"
                     f"Grading Scale: 0-{scale}\n\n"
-                    "Loading teacher menu..."
                 )
-                await show_teacher_menu(update, context)
                 return TEACHER_MENU
             else:
                 keyboard = [
@@ -512,49 +820,13 @@ async def handle_teacher_register(update: Update, context: ContextTypes.DEFAULT_
 # TEACHER MENU & FEATURES
 # ============================================================================
 
-async def show_teacher_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show teacher main menu - from message"""
+async def show_teacher_menu(message, context: ContextTypes.DEFAULT_TYPE, header=""):
+    """Send teacher main menu as a reply to message, prefixed by header (Markdown)"""
     full_name = context.user_data.get('full_name', 'Teacher')
     
-    keyboard = [
-        [InlineKeyboardButton("Create Assignment", callback_data="create_assignment")],
-        [InlineKeyboardButton("My Assignments", callback_data="my_assignments")],
-        [InlineKeyboardButton("Quick Grade", callback_data="quick_grade")],
-        [InlineKeyboardButton("Results & Analytics", callback_data="view_results")],
-        [InlineKeyboardButton("Logout", callback_data="logout")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        f"**TEACHER DASHBOARD**\n\n"
-        f"Welcome, {full_name}!\n\n"
-        "What would you like to do?",
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
-    )
-    
-    return TEACHER_MENU
-
-async def show_teacher_menu_from_callback(query, context: ContextTypes.DEFAULT_TYPE):
-    """Show teacher main menu - from callback query"""
-    full_name = context.user_data.get('full_name', 'Teacher')
-    
-    keyboard = [
-        [InlineKeyboardButton("Create Assignment", callback_data="create_assignment")],
-        [InlineKeyboardButton("My Assignments", callback_data="my_assignments")],
-        [InlineKeyboardButton("Quick Grade", callback_data="quick_grade")],
-        [InlineKeyboardButton("Results & Analytics", callback_data="view_results")],
-        [InlineKeyboardButton("Logout", callback_data="logout")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.message.reply_text(
-        f"**TEACHER DASHBOARD**\n\n"
-        f"Welcome, {full_name}!\n\n"
-        "What would you like to do?",
-        reply_markup=reply_markup,
+    await message.reply_text(
+        header + TEACHER_MENU_TEXT.format(name=escape_markdown(full_name)),
+        reply_markup=TEACHER_MENU_MARKUP,
         parse_mode="Markdown"
     )
     
@@ -563,25 +835,12 @@ async def show_teacher_menu_from_callback(query, context: ContextTypes.DEFAULT_T
 async def back_to_teacher_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Back to teacher menu from callback"""
     query = update.callback_query
-    await query.answer()
-    
     full_name = context.user_data.get('full_name', 'Teacher')
     
-    keyboard = [
-        [InlineKeyboardButton("Create Assignment", callback_data="create_assignment")],
-        [InlineKeyboardButton("My Assignments", callback_data="my_assignments")],
-        [InlineKeyboardButton("Quick Grade", callback_data="quick_grade")],
-        [InlineKeyboardButton("Results & Analytics", callback_data="view_results")],
-        [InlineKeyboardButton("Logout", callback_data="logout")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(
-        f"**TEACHER DASHBOARD**\n\n"
-        f"Welcome, {full_name}!\n\n"
-        "What would you like to do?",
-        reply_markup=reply_markup,
+    await answer_and_edit(
+        query,
+        TEACHER_MENU_TEXT.format(name=escape_markdown(full_name)),
+        reply_markup=TEACHER_MENU_MARKUP,
         parse_mode="Markdown"
     )
     
@@ -590,13 +849,11 @@ async def back_to_teacher_menu(update: Update, context: ContextTypes.DEFAULT_TYP
 async def create_assignment_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start creating assignment"""
     query = update.callback_query
-    await query.answer()
-    
-    keyboard = [[InlineKeyboardButton("Back", callback_data="teacher_menu")]]
-    await query.edit_message_text(
+    await answer_and_edit(
+        query,
         "**CREATE NEW ASSIGNMENT**\n\n"
         "Step 1: Enter assignment title",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=BACK_TO_TEACHER_MARKUP,
         parse_mode="Markdown"
     )
     
@@ -609,67 +866,34 @@ async def handle_assignment_creation(update: Update, context: ContextTypes.DEFAU
     assign_step = context.user_data.get('assign_step')
     teacher_id = context.user_data.get('teacher_id')
     
-    if assign_step == 'title':
-        context.user_data['assign_title'] = text
-        await update.message.reply_text(
-            "Step 2: Enter the question/assignment text"
-        )
-        context.user_data['assign_step'] = 'question'
+    if await handle_text_step(update, context, ASSIGNMENT_STEPS, 'assign_step'):
         return CREATE_QUESTION
     
-    elif assign_step == 'question':
-        context.user_data['assign_question'] = text
-        keyboard = [
-            [InlineKeyboardButton("Short Answer", callback_data="type_short")],
-            [InlineKeyboardButton("Exact Match", callback_data="type_exact")],
-            [InlineKeyboardButton("Keyword Based", callback_data="type_keyword")],
-            [InlineKeyboardButton("AI Semantic", callback_data="type_semantic")],
-        ]
-        await update.message.reply_text(
-            "Step 3: Choose question type",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return CREATE_QUESTION
-    
-    elif assign_step == 'answer':
-        context.user_data['assign_answer'] = text
-        await update.message.reply_text(
-            "Step 5: Enter the maximum score (e.g., 5, 10, 20, 100)"
-        )
-        context.user_data['assign_step'] = 'max_score'
-        return CREATE_QUESTION
-    
-    elif assign_step == 'max_score':
+    if assign_step == 'max_score':
         try:
             max_score = int(text)
             
-            conn = sqlite3.connect("exam_data.db")
-            c = conn.cursor()
-            c.execute("SELECT grading_scale FROM teachers WHERE teacher_id=?", (teacher_id,))
-            result = c.fetchone()
-            scale = result[0] if result else 100
-            conn.close()
-            
-            assignment_id = str(uuid.uuid4())
-            code = generate_assignment_code()
+            # Known since login/registration; only older sessions need the lookup
+            scale = context.user_data.get('grading_scale')
+            if scale is None:
+                scale = await asyncio.to_thread(get_teacher_grading_scale, teacher_id)
+                context.user_data['grading_scale'] = scale
+            code = await asyncio.to_thread(
+                create_assignment, teacher_id, context.user_data['assign_title'],
+                context.user_data['assign_question'], context.user_data['assign_type'],
+                max_score, scale, context.user_data['assign_answer']
+            )
             
-            conn = sqlite3.connect("exam_data.db")
-            c = conn.cursor()
-            c.execute('''INSERT INTO assignments 
-                        (assignment_id, teacher_id, code, title, question, 
-                         question_type, max_score, grading_scale, created_at, answers)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                      (assignment_id, teacher_id, code, context.user_data['assign_title'],
-                       context.user_data['assign_question'], context.user_data['assign_type'],
-                       max_score, scale, datetime.now(), context.user_data['assign_answer']))
-            conn.commit()
-            conn.close()
+            if context.user_data['assign_type'] == 'AI Semantic':
+                asyncio.get_running_loop().run_in_executor(
+                    _POOL, precompute_answer_embeddings, [context.user_data['assign_answer']]
+                )
             
             keyboard = [[InlineKeyboardButton("Back to Menu", callback_data="teacher_menu")]]
             
             await update.message.reply_text(
                 f"**ASSIGNMENT CREATED!**\n\n"
-                f"**Title:** {context.user_data['assign_title']}\n"
+                f"**Title:** {escape_markdown(context.user_data['assign_title'])}\n"
                 f"**Assignment Code:** `{code}`\n"
                 f"**Max Score:** {max_score}/{scale}\n"
                 f"**Question Type:** {context.user_data['assign_type']}\n\n"
@@ -689,8 +913,6 @@ async def handle_assignment_creation(update: Update, context: ContextTypes.DEFAU
 async def handle_assignment_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle assignment type selection"""
     query = update.callback_query
-    await query.answer()
-    
     type_map = {
         'type_short': 'Short Answer',
         'type_exact': 'Exact Match',
@@ -702,7 +924,8 @@ async def handle_assignment_type(update: Update, context: ContextTypes.DEFAULT_T
     context.user_data['assign_type'] = assign_type
     context.user_data['assign_step'] = 'answer'
     
-    await query.edit_message_text(
+    await answer_and_edit(
+        query,
         f"Question type: **{assign_type}**\n\n"
         f"Step 4: Now send the correct answer(s):",
         parse_mode="Markdown"
@@ -713,16 +936,16 @@ async def handle_assignment_type(update: Update, context: ContextTypes.DEFAULT_T
 async def my_assignments_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show teacher's assignments"""
     query = update.callback_query
-    await query.answer()
-    
     teacher_id = context.user_data.get('teacher_id')
-    assignments = get_teacher_assignments(teacher_id)
+    _, assignments = await asyncio.gather(
+        query.answer(), asyncio.to_thread(get_teacher_assignments, teacher_id)
+    )
     
     if assignments:
         text = "**MY ASSIGNMENTS**\n\n"
         for i, (aid, code, title, question, qtype, max_score, created) in enumerate(assignments[:10], 1):
-            submissions = get_assignment_submissions(aid)
-            text += f"{i}. **{title}**\n"
+            submissions = await asyncio.to_thread(get_assignment_submissions, aid)
+            text += f"{i}. **{escape_markdown(title)}**\n"
             text += f"   Code: `{code}`\n"
             text += f"   Type: {qtype} | Max: {max_score}\n"
             text += f"   Submissions: {len(submissions)}\n\n"
@@ -745,10 +968,10 @@ async def my_assignments_handler(update: Update, context: ContextTypes.DEFAULT_T
 async def view_results_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show results and analytics"""
     query = update.callback_query
-    await query.answer()
-    
     teacher_id = context.user_data.get('teacher_id')
-    assignments = get_teacher_assignments(teacher_id)
+    _, assignments = await asyncio.gather(
+        query.answer(), asyncio.to_thread(get_teacher_assignments, teacher_id)
+    )
     
     total_submissions = 0
     total_score = 0
@@ -758,7 +981,7 @@ async def view_results_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     
     if assignments:
         for aid, code, title, question, qtype, max_score, created in assignments:
-            submissions = get_assignment_submissions(aid)
+            submissions = await asyncio.to_thread(get_assignment_submissions, aid)
             total_submissions += len(submissions)
             
             if submissions:
@@ -771,28 +994,26 @@ async def view_results_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         text += f"**Total Submissions:** {total_submissions}\n"
         
         if total_max > 0:
-            avg_percent = (total_score / total_max) * 100
+            avg_percent = score_percentage(total_score, total_max)
             text += f"**Average Score:** {avg_percent:.1f}%\n"
         
         text += "\n**Recent Submissions:**\n"
         
         count = 0
         for aid, code, title, question, qtype, max_score, created in assignments:
-            submissions = get_assignment_submissions(aid)
+            submissions = await asyncio.to_thread(get_assignment_submissions, aid)
             for sub in submissions[:3]:
                 if count < 5:
                     sub_id, name, sid, answer, score, max_s, submitted = sub
                     score_str = f"{score}/{max_s}" if score is not None else "Pending"
-                    text += f"- {name}: {title} = {score_str}\n"
+                    text += f"- {escape_markdown(name)}: {escape_markdown(title)} = {score_str}\n"
                     count += 1
     else:
         text += "No assignments or submissions yet.\n\nCreate assignments to start collecting data!"
     
-    keyboard = [[InlineKeyboardButton("Back", callback_data="teacher_menu")]]
-    
     await query.edit_message_text(
         text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=BACK_TO_TEACHER_MARKUP,
         parse_mode="Markdown"
     )
     
@@ -803,20 +1024,12 @@ async def view_results_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 # ============================================================================
 
 async def student_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Student main menu"""
+    """Student main menu (role selection and every "Back to Menu" button)"""
     query = update.callback_query
-    await query.answer()
-    
-    keyboard = [
-        [InlineKeyboardButton("Find Assignment", callback_data="find_assignment")],
-        [InlineKeyboardButton("Quick Grade", callback_data="quick_grade_student")],
-        [InlineKeyboardButton("Back", callback_data="back_to_start")]
-    ]
-    
-    await query.edit_message_text(
-        "**STUDENT PORTAL**\n\n"
-        "What would you like to do?",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+    await answer_and_edit(
+        query,
+        STUDENT_MENU_TEXT,
+        reply_markup=STUDENT_MENU_MARKUP,
         parse_mode="Markdown"
     )
     
@@ -825,14 +1038,11 @@ async def student_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def find_assignment_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Find assignment by code"""
     query = update.callback_query
-    await query.answer()
-    
-    keyboard = [[InlineKeyboardButton("Back", callback_data="student_menu")]]
-    
-    await query.edit_message_text(
+    await answer_and_edit(
+        query,
         "**FIND ASSIGNMENT**\n\n"
         "Enter the assignment code (given by your teacher):",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=BACK_TO_STUDENT_MARKUP,
         parse_mode="Markdown"
     )
     
@@ -843,12 +1053,7 @@ async def handle_assignment_code(update: Update, context: ContextTypes.DEFAULT_T
     """Handle student entering assignment code"""
     code = update.message.text.strip().upper()
     
-    conn = sqlite3.connect("exam_data.db")
-    c = conn.cursor()
-    c.execute('''SELECT assignment_id, title, question, question_type, max_score, grading_scale, answers
-                 FROM assignments WHERE code=?''', (code,))
-    result = c.fetchone()
-    conn.close()
+    result = await asyncio.to_thread(get_assignment_by_code, code)
     
     if result:
         assignment_id, title, question, qtype, max_score, scale, answers = result
@@ -866,8 +1071,8 @@ async def handle_assignment_code(update: Update, context: ContextTypes.DEFAULT_T
         
         await update.message.reply_text(
             f"**ASSIGNMENT FOUND!**\n\n"
-            f"**Title:** {title}\n"
-            f"**Question:** {question}\n"
+            f"**Title:** {escape_markdown(title)}\n"
+            f"**Question:** {escape_markdown(question)}\n"
             f"**Max Score:** {max_score}/{scale}\n\n"
             f"Ready to answer?",
             reply_markup=InlineKeyboardMarkup(keyboard),
@@ -876,25 +1081,21 @@ async def handle_assignment_code(update: Update, context: ContextTypes.DEFAULT_T
         
         return FIND_ASSIGNMENT
     else:
-        keyboard = [[InlineKeyboardButton("Back", callback_data="student_menu")]]
         await update.message.reply_text(
             "Assignment code not found.\n\n"
             "Please check the code and try again.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=BACK_TO_STUDENT_MARKUP
         )
         return FIND_ASSIGNMENT
 
 async def submit_answer_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Student submits answer"""
     query = update.callback_query
-    await query.answer()
-    
-    keyboard = [[InlineKeyboardButton("Back", callback_data="student_menu")]]
-    
-    await query.edit_message_text(
+    await answer_and_edit(
+        query,
         "**SUBMIT YOUR ANSWER**\n\n"
         "Type your answer below:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=BACK_TO_STUDENT_MARKUP,
         parse_mode="Markdown"
     )
     
@@ -908,6 +1109,8 @@ async def process_student_answer(update: Update, context: ContextTypes.DEFAULT_T
     
     if update.message.text:
         answer = update.message.text
+        if await reject_long_input(update.message, answer, MAX_ANSWER_LEN):
+            return ANSWER_SUBMISSION
     else:
         await update.message.reply_text("Please send a text answer")
         return ANSWER_SUBMISSION
@@ -918,24 +1121,19 @@ async def process_student_answer(update: Update, context: ContextTypes.DEFAULT_T
     correct_answers = context.user_data.get('correct_answers', '')
     
     qtype_normalized = qtype.lower().replace(' ', '')
-    score, detail = grade_answer(answer, correct_answers, max_score, qtype_normalized)
+    loop = asyncio.get_running_loop()
+    score, detail = await loop.run_in_executor(
+        _POOL, grade_answer, answer, correct_answers, max_score, qtype_normalized
+    )
     
-    submission_id = str(uuid.uuid4())
-    conn = sqlite3.connect("exam_data.db")
-    c = conn.cursor()
-    c.execute('''INSERT INTO submissions
-                (submission_id, assignment_id, student_name, student_id, answer, score, max_score, submitted_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-              (submission_id, assignment_id, student_name, student_id, answer, score, max_score, datetime.now()))
-    conn.commit()
-    conn.close()
+    queue_submission(assignment_id, student_name, student_id, answer, score, max_score)
     
     keyboard = [
         [InlineKeyboardButton("Find Another", callback_data="find_assignment")],
         [InlineKeyboardButton("Back to Menu", callback_data="student_menu")]
     ]
     
-    percentage = (score / max_score * 100) if max_score > 0 else 0
+    percentage = score_percentage(score, max_score)
     
     await update.message.reply_text(
         f"**ANSWER SUBMITTED!**\n\n"
@@ -949,26 +1147,6 @@ async def process_student_answer(update: Update, context: ContextTypes.DEFAULT_T
     
     return STUDENT_MAIN
 
-async def back_to_student_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Back to student menu"""
-    query = update.callback_query
-    await query.answer()
-    
-    keyboard = [
-        [InlineKeyboardButton("Find Assignment", callback_data="find_assignment")],
-        [InlineKeyboardButton("Quick Grade", callback_data="quick_grade_student")],
-        [InlineKeyboardButton("Back", callback_data="back_to_start")]
-    ]
-    
-    await query.edit_message_text(
-        "**STUDENT PORTAL**\n\n"
-        "What would you like to do?",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
-    )
-    
-    return STUDENT_MAIN
-
 # ============================================================================
 # QUICK GRADE (FOR ANYONE)
 # ============================================================================
@@ -976,15 +1154,12 @@ async def back_to_student_menu(update: Update, context: ContextTypes.DEFAULT_TYP
 async def quick_grade_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Quick grade entry point"""
     query = update.callback_query
-    await query.answer()
-    
-    keyboard = [[InlineKeyboardButton("Back", callback_data="back_to_start")]]
-    
-    await query.edit_message_text(
+    await answer_and_edit(
+        query,
         "**QUICK GRADE**\n\n"
         "This is quick grading for anyone (teachers/students)\n\n"
         "Step 1: Enter the question",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=BACK_TO_START_MARKUP,
         parse_mode="Markdown"
     )
     
@@ -996,71 +1171,42 @@ async def handle_quick_grade(update: Update, context: ContextTypes.DEFAULT_TYPE)
     text = update.message.text.strip()
     step = context.user_data.get('quick_grade_step')
     
-    if step == 'question':
-        context.user_data['qg_question'] = text
-        await update.message.reply_text(
-            "Step 2: Enter the correct answer(s)"
-        )
-        context.user_data['quick_grade_step'] = 'correct_answer'
-        return QUICK_GRADE_MENU
-    
-    elif step == 'correct_answer':
-        context.user_data['qg_correct'] = text
-        await update.message.reply_text(
-            "Step 3: Enter the student's answer"
-        )
-        context.user_data['quick_grade_step'] = 'student_answer'
-        return QUICK_GRADE_MENU
-    
-    elif step == 'student_answer':
-        context.user_data['qg_student_answer'] = text
-        await update.message.reply_text(
-            "Step 4: Enter max score (e.g., 5, 10, 20, 100)"
-        )
-        context.user_data['quick_grade_step'] = 'max_score'
+    if await handle_text_step(update, context, QUICK_GRADE_STEPS, 'quick_grade_step'):
         return QUICK_GRADE_MENU
     
-    elif step == 'max_score':
+    if step == 'max_score':
         try:
             max_score = int(text)
             
-            score, detail = grade_answer(
+            loop = asyncio.get_running_loop()
+            score, detail = await loop.run_in_executor(
+                _POOL, grade_answer,
                 context.user_data['qg_student_answer'],
                 context.user_data['qg_correct'],
                 max_score,
                 'keyword'
             )
             
-            keyboard = [
-                [InlineKeyboardButton("Grade Another", callback_data="quick_grade")],
-                [InlineKeyboardButton("Back", callback_data="back_to_start")]
-            ]
-            
-            percentage = (score / max_score * 100) if max_score > 0 else 0
+            percentage = score_percentage(score, max_score)
             
             await update.message.reply_text(
                 f"**GRADING RESULT**\n\n"
-                f"**Question:** {context.user_data['qg_question']}\n"
-                f"**Student Answer:** {context.user_data['qg_student_answer']}\n"
-                f"**Correct Answer:** {context.user_data['qg_correct']}\n\n"
+                f"**Question:** {escape_markdown(context.user_data['qg_question'])}\n"
+                f"**Student Answer:** {escape_markdown(context.user_data['qg_student_answer'])}\n"
+                f"**Correct Answer:** {escape_markdown(context.user_data['qg_correct'])}\n\n"
                 f"**Score:** {score}/{max_score}\n"
                 f"**Percentage:** {percentage:.1f}%\n"
                 f"**Detail:** {detail}",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=QUICK_GRADE_RESULT_MARKUP,
                 parse_mode="Markdown"
             )
             
             teacher_id = context.user_data.get('teacher_id')
             if teacher_id:
-                conn = sqlite3.connect("exam_data.db")
-                c = conn.cursor()
-                c.execute('''INSERT INTO quick_grades
-                            (grade_id, teacher_id, question, answer_given, score, max_score, graded_at)
-                            VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                          (str(uuid.uuid4()), teacher_id, context.user_data['qg_question'],
-                           context.user_data['qg_student_answer'], score, max_score, datetime.now()))
-                conn.commit()
-                conn.close()
+                queue_quick_grade(
+                    teacher_id, context.user_data['qg_question'],
+                    context.user_data['qg_student_answer'], score, max_score
+                )
             
             context.user_data['quick_grade_step'] = None
             return QUICK_GRADE_MENU
@@ -1075,22 +1221,23 @@ async def handle_quick_grade(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # NAVIGATION HANDLERS
 # ============================================================================
 
+async def still_processing(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answer input sent while the user's previous update is still being handled"""
+    if update.callback_query:
+        await update.callback_query.answer("Still processing your last request, please wait...")
+    elif update.message:
+        await update.message.reply_text("Still processing your last message, please wait...")
+
 async def back_to_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Go back to start"""
     query = update.callback_query
-    await query.answer()
-    
     context.user_data.clear()
     
-    keyboard = [
-        [InlineKeyboardButton("Teacher Account", callback_data="teacher_mode")],
-        [InlineKeyboardButton("Student", callback_data="student_mode")]
-    ]
-    
-    await query.edit_message_text(
+    await answer_and_edit(
+        query,
         "**Smart Exam & Assignment System**\n\n"
         "Choose your role:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=ROLE_MENU_MARKUP,
         parse_mode="Markdown"
     )
     return START
@@ -1098,19 +1245,13 @@ async def back_to_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def logout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Logout teacher"""
     query = update.callback_query
-    await query.answer()
-    
     context.user_data.clear()
     
-    keyboard = [
-        [InlineKeyboardButton("Teacher Account", callback_data="teacher_mode")],
-        [InlineKeyboardButton("Student", callback_data="student_mode")]
-    ]
-    
-    await query.edit_message_text(
+    await answer_and_edit(
+        query,
         "**Logged out successfully!**\n\n"
         "Choose your role to continue:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=ROLE_MENU_MARKUP,
         parse_mode="Markdown"
     )
     return START
@@ -1121,36 +1262,7 @@ async def logout(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show comprehensive help"""
-    
-    help_text = """
-**EXAM GRADING BOT - HELP GUIDE**
-
-**FOR TEACHERS:**
-1. Click /start and select "Teacher Mode"
-2. Register with your name, username, and password
-3. Create assignments with unique codes
-4. Share codes with students
-5. View results and analytics
-
-**FOR STUDENTS:**
-1. Click /start and select "Student"
-2. Enter assignment code from teacher
-3. Submit your answer
-4. Get instant grading
-
-**QUICK GRADE:**
-- Grade any answer instantly
-- No login required
-- Great for quick checks
-
-**COMMANDS:**
-/start - Start the bot
-/help - Show this help
-
-Need more help? Contact your teacher or administrator.
-"""
-    
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+    await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
 
 # ============================================================================
 # ERROR HANDLER
@@ -1158,19 +1270,87 @@ Need more help? Contact your teacher or administrator.
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors gracefully"""
+    # Timeouts and dropped connections (TimedOut is a NetworkError) are
+    # routine during long polling and PTB retries them itself
+    if isinstance(context.error, NetworkError):
+        print(f"Network error: {context.error}")
+        return
     print(f"Error: {context.error}")
+    traceback.print_exception(type(context.error), context.error, context.error.__traceback__)
 
 # ============================================================================
 # MAIN - BOT SETUP
 # ============================================================================
 
+def warm_up_models():
+    """Load the embedding model at boot instead of on the first submission"""
+    if not USE_EMBEDDINGS:
+        return
+    started = time.perf_counter()
+    try:
+        EMBED_MODEL.encode(["warmup"])
+        print(f"Embedding model warmed up in {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        print(f"Embedding warmup failed: {e}")
+
+async def post_init(application):
+    """Start background tasks once the event loop is running"""
+    global WRITER_TASK
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+    )
+    WRITER_TASK = asyncio.create_task(db_writer())
+
+async def post_stop(application):
+    """Flush queued writes once polling has stopped and handlers have finished"""
+    await WRITE_QUEUE.join()
+    if WRITER_TASK:
+        WRITER_TASK.cancel()
+
+async def post_shutdown(application):
+    """Close the shared SQLite connection on the way out"""
+    with DB_LOCK:
+        if DB_CONN is not None:
+            DB_CONN.close()
+
 def main():
     """Initialize and run bot"""
+    if UVLOOP_AVAILABLE:
+        # Must be set before the Application creates its loop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     db = init_db()
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # Shared keep-alive connection pool for outgoing API calls; getUpdates
+    # long-polls on its own small pool so it never starves replies
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .request(HTTPXRequest(
+            connection_pool_size=64,
+            pool_timeout=10.0,
+            connect_timeout=10.0,
+            read_timeout=15.0,
+            write_timeout=15.0,
+            http_version="1.1",
+        ))
+        # Only one getUpdates call is ever in flight; PTB adds the 50s poll
+        # timeout on top of read_timeout for it
+        .get_updates_request(HTTPXRequest(connection_pool_size=1, read_timeout=10.0))
+        # Handle each update in its own task so one slow grading request
+        # doesn't hold up everyone else's updates
+        .defaults(Defaults(block=False))
+        .persistence(PicklePersistence(filepath=STATE_FILE, update_interval=STATE_FLUSH_INTERVAL))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    warm_up_models()
+    precompute_stored_answer_embeddings()
     
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        name="main_conv",
+        persistent=True,
+        entry_points=[CommandHandler("start", start, block=False)],
         states={
             START: [
                 CallbackQueryHandler(teacher_mode_selector, pattern="^teacher_mode$"),
@@ -1180,63 +1360,94 @@ def main():
             TEACHER_LOGIN: [
                 CallbackQueryHandler(proceed_teacher_login, pattern="^proceed_login$"),
                 CallbackQueryHandler(proceed_teacher_register, pattern="^proceed_register$"),
-                CallbackQueryHandler(back_to_start, pattern="^back_to_start$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_teacher_auth),
+                CallbackQueryHandler(back_to_start, pattern="^back_to_start$", block=False),
+                MessageHandler(TEXT_INPUT, handle_teacher_auth),
             ],
             TEACHER_REGISTER: [
-                CallbackQueryHandler(back_to_start, pattern="^back_to_start$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_teacher_register),
+                CallbackQueryHandler(back_to_start, pattern="^back_to_start$", block=False),
+                MessageHandler(TEXT_INPUT, handle_teacher_register),
             ],
             TEACHER_MENU: [
                 CallbackQueryHandler(create_assignment_start, pattern="^create_assignment$"),
                 CallbackQueryHandler(my_assignments_handler, pattern="^my_assignments$"),
                 CallbackQueryHandler(view_results_handler, pattern="^view_results$"),
                 CallbackQueryHandler(quick_grade_start, pattern="^quick_grade$"),
-                CallbackQueryHandler(logout, pattern="^logout$"),
+                CallbackQueryHandler(logout, pattern="^logout$", block=False),
                 CallbackQueryHandler(back_to_teacher_menu, pattern="^teacher_menu$"),
             ],
             CREATE_QUESTION: [
                 CallbackQueryHandler(handle_assignment_type, pattern="^type_"),
                 CallbackQueryHandler(back_to_teacher_menu, pattern="^teacher_menu$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_assignment_creation),
+                MessageHandler(TEXT_INPUT, handle_assignment_creation),
             ],
             STUDENT_MAIN: [
                 CallbackQueryHandler(find_assignment_start, pattern="^find_assignment$"),
                 CallbackQueryHandler(quick_grade_start, pattern="^quick_grade_student$"),
-                CallbackQueryHandler(back_to_student_menu, pattern="^student_menu$"),
-                CallbackQueryHandler(back_to_start, pattern="^back_to_start$"),
+                CallbackQueryHandler(student_mode, pattern="^student_menu$"),
+                CallbackQueryHandler(back_to_start, pattern="^back_to_start$", block=False),
             ],
             FIND_ASSIGNMENT: [
                 CallbackQueryHandler(submit_answer_handler, pattern="^submit_answer$"),
-                CallbackQueryHandler(back_to_student_menu, pattern="^student_menu$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_assignment_code),
+                CallbackQueryHandler(student_mode, pattern="^student_menu$"),
+                MessageHandler(TEXT_INPUT, handle_assignment_code),
             ],
             ANSWER_SUBMISSION: [
-                CallbackQueryHandler(back_to_student_menu, pattern="^student_menu$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, process_student_answer),
+                CallbackQueryHandler(student_mode, pattern="^student_menu$"),
+                MessageHandler(TEXT_INPUT, process_student_answer),
             ],
             QUICK_GRADE_MENU: [
                 CallbackQueryHandler(quick_grade_start, pattern="^quick_grade$"),
-                CallbackQueryHandler(back_to_start, pattern="^back_to_start$"),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_quick_grade),
+                CallbackQueryHandler(back_to_start, pattern="^back_to_start$", block=False),
+                MessageHandler(TEXT_INPUT, handle_quick_grade),
+            ],
+            # Handlers run non-blocking, so while one is still running for a
+            # user their conversation is pending and further input lands here
+            # instead of in the step that hasn't advanced yet
+            ConversationHandler.WAITING: [
+                CallbackQueryHandler(still_processing),
+                MessageHandler(filters.ALL, still_processing),
             ],
         },
         fallbacks=[
-            CommandHandler("start", start),
-            CommandHandler("help", help_command),
+            CommandHandler("start", start, block=False),
+            CommandHandler("help", help_command, block=False),
         ],
     )
     
-    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("help", help_command, block=False))
     app.add_handler(conv_handler)
     app.add_error_handler(error_handler)
     
-    print("Advanced Exam Grading Bot v2 is ONLINE!")
-    print("Features: Teacher Accounts | Dynamic Questions | Student Answers")
-    print("Features: Quick Grading | Customizable Scales | Proper Navigation")
-    print("\nWaiting for users...\n")
+    # One write for the whole banner
+    print(
+        "Advanced Exam Grading Bot v2 is ONLINE!\n"
+        "Features: Teacher Accounts | Dynamic Questions | Student Answers\n"
+        "Features: Quick Grading | Customizable Scales | Proper Navigation\n"
+        "\nWaiting for users...\n",
+        flush=True
+    )
     
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        print(f"Receiving updates via webhook at {WEBHOOK_URL}/{WEBHOOK_PATH}")
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY],
+            bootstrap_retries=-1,
+        )
+        return
+    
+    # Long-poll for up to 50s (under Telegram's 60s cap) so an idle bot makes
+    # one getUpdates call a minute, and fetch again right away after a batch
+    app.run_polling(
+        allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY],
+        timeout=50,
+        poll_interval=0.0,
+        bootstrap_retries=-1,
+    )
 
 if __name__ == "__main__":
     main()